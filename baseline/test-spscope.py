@@ -11,6 +11,7 @@ from baseline.SpatialScope.utils import ConcatCells
 
 
 from process.result_analysis import clustering_metrics
+from preprocess.utils import reference_clustering
 
 
 warnings.filterwarnings('ignore')
@@ -310,10 +311,8 @@ class CalculateMeteics:
         # cpy_x = adata_spatial2[np.array(a['spot_index']), :].copy()
         cpy_x.X = impu
 
-        sc.tl.pca(ad_sp)
-        sc.pp.neighbors(ad_sp, n_pcs=30, n_neighbors=30)
-        sc.tl.leiden(ad_sp)
-        tmp_adata1 = ad_sp
+        # raw 对所有方法都相同, 参考聚类只在第一次计算
+        tmp_adata1 = reference_clustering(ad_sp)
 
         sc.tl.pca(cpy_x)
         sc.pp.neighbors(cpy_x, n_pcs=30, n_neighbors=30)
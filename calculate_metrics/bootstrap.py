@@ -0,0 +1,250 @@
+"""对所有方法的 PCC / SSIM / RMSE / JS 和 AS 做 bootstrap, 给出置信区间
+
+每次重采样用 spot 的重复次数 w (B, n) 表示, 各指标都写成按 w 加权的列求和:
+均值, 方差, 协方差, RMSE 以及 JS 中只与 p 或 q 有关的项都是 w 与 (n, genes) 矩阵的乘积,
+只有 JS 中的 (p + q) log(p + q) 需要对每次重采样逐项计算: 每个基因中最常见的 (truth, 预测) 取值
+(一般是两者都为 0, 或者 min-max 归一化后 0 对应的值) 的贡献用一次乘积得到, 其余的位置逐项计算.
+SSIM 的动态范围 M 与 min-max 归一化一样看作预处理, 在全部数据上算一次.
+除 SSIM 的 M 外, 结果与对重采样后的矩阵调用 score_genes 相同. 在仓库根目录运行:
+
+    python -m calculate_metrics.bootstrap --document dataset1_MG --B 1000
+"""
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.stats import rankdata
+from preprocess.metrics import ssim_from_moments
+from calculate_metrics.evaluate import METHODS, METRICS, ASCENDING, SCHEMES, normalize_data, score_genes
+
+
+def _xlogx(x):
+    # x log x, 0 处取 0; 负值只出现在 JS 为 inf 的列, 同样取 0
+    out = np.zeros_like(x)
+    np.log(x, out=out, where=x > 0)
+    return np.multiply(x, out, out=out)
+
+
+def _counts(idx, n):
+    # 下标矩阵 (B, n) -> 每个 spot 被抽到的次数 (B, n)
+    offset = np.arange(idx.shape[0])[:, None] * n
+    return np.bincount((idx + offset).ravel(), minlength=idx.shape[0] * n).reshape(idx.shape[0], n).astype(float)
+
+
+class _Columns:
+    """一个 (n, genes) 矩阵上与重采样无关的部分, 只算一次"""
+
+    def __init__(self, values):
+        self.values = values
+        self.mean = values.mean(axis=0)
+        self.centered = values - self.mean
+        self.square = self.centered ** 2
+        self.xlogx = _xlogx(values)
+        self.max = values.max(axis=0)
+
+
+def _most_common(a, b):
+    # 每一列中出现次数最多的 (a, b) 取值, 按 (a, b) 排序后找最长的一段
+    order = np.lexsort((b, a), axis=0)
+    a, b = np.take_along_axis(a, order, axis=0), np.take_along_axis(b, order, axis=0)
+    new = np.ones(a.shape, dtype=bool)
+    new[1:] = (a[1:] != a[:-1]) | (b[1:] != b[:-1])
+    index = np.arange(a.shape[0])[:, None]
+    start = np.maximum.accumulate(np.where(new, index, 0), axis=0)
+    last = np.argmax(index - start, axis=0)[None]
+    return np.take_along_axis(a, last, axis=0)[0], np.take_along_axis(b, last, axis=0)[0]
+
+
+def _support(a, b):
+    # 每个基因最常见的 (truth, 预测) 取值, 等于它的位置 (n, genes) 以及其余位置 (按基因排列) 和把它们按基因求和的稀疏矩阵
+    base_a, base_b = _most_common(a.values, b.values)
+    is_base = (a.values == base_a) & (b.values == base_b)
+    genes, rows = np.nonzero(~is_base.T)
+    indicator = sp.csr_matrix((np.ones(len(rows)), (np.arange(len(rows)), genes)),
+                              shape=(len(rows), a.values.shape[1]))
+    return base_a, base_b, is_base.astype(float), rows, genes, a.values[rows, genes], b.values[rows, genes], indicator
+
+
+def resample_scores(truth, pred, counts, rmse_offset=0., support=None):
+    """在一组重采样上计算每个基因的 PCC / SSIM / RMSE / JS
+
+    Args:
+        truth (_Columns): ground truth.
+        pred (_Columns): 预测, 与 truth 行列对应.
+        counts (np.ndarray): (B, n), 每次重采样中每个 spot 的重复次数, 每行的和为 n.
+        rmse_offset (float, optional): 加到 RMSE 上的常数. Defaults to 0.
+        support (tuple, optional): _support(truth, pred) 的结果, 多批重采样时只算一次. Defaults to None.
+
+    Returns:
+        np.ndarray: (B, genes, 4), 最后一维的顺序与 METRICS 相同
+    """
+    a, b = truth, pred
+    base_a, base_b, is_base, rows, genes, a_values, b_values, indicator = support or _support(a, b)
+    n = counts.shape[1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # 在各列 (全部数据的) 均值附近展开, 避免 E[x^2] - E[x]^2 的抵消误差
+        mu_a, mu_b = counts @ a.centered / n, counts @ b.centered / n
+        var_a = counts @ a.square / n - mu_a ** 2
+        var_b = counts @ b.square / n - mu_b ** 2
+        cov = counts @ (a.centered * b.centered) / n - mu_a * mu_b
+        diff = a.values - b.values
+        rmse = np.sqrt(counts @ (diff * diff) / n) + rmse_offset
+        pcc = np.clip(cov / np.sqrt(var_a * var_b), -1, 1)
+        ssim = ssim_from_moments(mu_a + a.mean, mu_b + b.mean, var_a, var_b, cov, np.maximum(a.max, b.max))
+
+        # JS = (2 log 2 + sum p log p + sum q log q - sum (p + q) log(p + q)) / 2, p, q 为归一化后的列
+        sum_a, sum_b = counts @ a.values, counts @ b.values
+        p_log_p = counts @ a.xlogx / sum_a - np.log(sum_a)
+        q_log_q = counts @ b.xlogx / sum_b - np.log(sum_b)
+        # p + q = x / sum_a, x = a + b * sum_a / sum_b, 而 x 的加权和为 2 * sum_a
+        ratio = sum_a / sum_b
+        x = b_values * ratio[:, genes] + a_values
+        pq_log_pq = (counts @ is_base * _xlogx(base_b * ratio + base_a) + (_xlogx(x) * counts[:, rows]) @ indicator
+                     ) / sum_a - 2 * np.log(sum_a)
+        js = np.sqrt(np.maximum(np.log(2) + (p_log_p + q_log_q - pq_log_pq) / 2, 0))
+        # 与 scipy 相同, 抽到负值或者整列为 0 时 JS 为 inf
+        negative = ((a.values < 0) | (b.values < 0)).astype(float)
+        js[(counts @ negative > 0) | ~(sum_a > 0) | ~(sum_b > 0)] = np.inf
+    return np.stack([pcc, ssim, rmse, js], axis=-1)
+
+
+def _rank(values, axis, rank_method):
+    # 沿 axis 对每个指标排名, 方向与 ASCENDING 相同, nan 不参与排名
+    sign = np.array([1 if ASCENDING[metric] else -1 for metric in METRICS])
+    return rankdata(values * sign, method=rank_method, axis=axis, nan_policy='omit')
+
+
+def accuracy_score(values, axis, rank_method):
+    # 沿 axis 排名后的 AS, 与 evaluate.rank_genes 相同: 四个排名的和 / 4 / (个数 - 1)
+    ranks = _rank(values, axis, rank_method)
+    return np.nansum(ranks, axis=-1) / 4 / (values.shape[axis] - 1)
+
+
+def _interval(samples, alpha):
+    # 百分位数置信区间, 取区间外侧的次序统计量, 不插值 (JS 为 inf 时插值得到 nan);
+    # 个别重采样得到 nan (如抽到常数列) 时忽略
+    with np.errstate(invalid='ignore'):
+        return (np.nanquantile(samples, alpha / 2, axis=0, method='lower'),
+                np.nanquantile(samples, 1 - alpha / 2, axis=0, method='higher'))
+
+
+def bootstrap(result_dir, methods=METHODS, scheme='baseline', B=1000, resample_genes=False, alpha=0.05,
+              batch_size=32, seed=0):
+    """对 spot (以及可选的基因) 做 B 次重采样, 返回逐基因和方法层面的置信区间
+
+    min-max 归一化 (scheme='as') 和 SSIM 的动态范围 M 看作预处理, 在全部数据上算一次, 不随重采样改变.
+    逐基因的区间只对 spot 重采样; resample_genes=True 时方法层面的均值和 AS 还会对基因重采样.
+
+    Args:
+        result_dir (str): 包含 original.csv 和 {method}_prediction.csv 的目录.
+        methods (list, optional): 方法名, 没有预测文件的会被跳过. Defaults to METHODS.
+        scheme (str, optional): SCHEMES 中的约定. Defaults to 'baseline'.
+        B (int, optional): 重采样次数. Defaults to 1000.
+        resample_genes (bool, optional): 方法层面的统计是否同时对基因重采样. Defaults to False.
+        alpha (float, optional): 置信区间为 1 - alpha. Defaults to 0.05.
+        batch_size (int, optional): 每批的重采样次数, 内存占用约为 batch_size * n * genes 个 float64. Defaults to 32.
+        seed (int, optional): 随机种子. Defaults to 0.
+
+    Returns:
+        tuple: (genes, summary)
+            genes 为 {method: DataFrame}, 行为基因, 每个指标和 AS 有估计值以及 _low / _high 两列;
+            summary 为 DataFrame, 行为方法, 是各指标在基因上的均值和方法之间排名得到的 AS, 列的格式相同
+    """
+    config = SCHEMES[scheme]
+    truth = pd.read_csv(os.path.join(result_dir, 'original.csv'), index_col=0)
+    genes = truth.columns
+    true_values = truth.to_numpy(dtype=float)
+    preds = {}
+    for method in methods:
+        pred_path = os.path.join(result_dir, f'{method}_prediction.csv')
+        if not os.path.exists(pred_path):
+            print(f'{pred_path} not found, skip {method}')
+            continue
+        pred = pd.read_csv(pred_path, index_col=0)
+        if pred.shape[0] != true_values.shape[0]:
+            raise ValueError(f'{pred_path} has {pred.shape[0]} spots, expected {true_values.shape[0]}')
+        preds[method] = pred[genes].to_numpy(dtype=float)
+    methods = list(preds)
+
+    # 全部数据上的估计值
+    estimates = {method: score_genes(true_values, preds[method], genes, scheme) for method in methods}
+    if config['normalize']:
+        true_values = normalize_data(true_values)
+        preds = {method: normalize_data(values) for method, values in preds.items()}
+    truth = _Columns(true_values)
+    preds = {method: _Columns(values) for method, values in preds.items()}
+    supports = {method: _support(truth, pred) for method, pred in preds.items()}
+
+    # samples[b, m, g, k]: 第 b 次重采样, 第 m 个方法, 第 g 个基因的第 k 个指标
+    n, num_genes = true_values.shape
+    rng = np.random.default_rng(seed)
+    samples = np.empty((B, len(methods), num_genes, len(METRICS)))
+    for start in range(0, B, batch_size):
+        stop = min(start + batch_size, B)
+        counts = _counts(rng.integers(0, n, (stop - start, n)), n)
+        for m, method in enumerate(methods):
+            samples[start:stop, m] = resample_scores(truth, preds[method], counts, config['rmse_offset'],
+                                                     supports[method])
+
+    # 逐基因: 每个方法内在基因之间排名得到 AS
+    gene_as = accuracy_score(samples, axis=2, rank_method=config['rank_method'])
+    gene_results = {}
+    for m, method in enumerate(methods):
+        result = pd.DataFrame(index=genes)
+        for k, metric in enumerate(METRICS + ['AS']):
+            values = samples[:, m, :, k] if metric != 'AS' else gene_as[:, m]
+            result[metric] = estimates[method][metric]
+            result[metric + '_low'], result[metric + '_high'] = _interval(values, alpha)
+        gene_results[method] = result
+
+    # 方法层面: 各指标在基因上的均值 (与 evaluate.summarize 相同), 再在方法之间排名得到 AS
+    if resample_genes:
+        gene_idx = rng.integers(0, num_genes, (B, num_genes))
+        samples = np.take_along_axis(samples, gene_idx[:, None, :, None], axis=2)
+    with np.errstate(invalid='ignore'):
+        means = samples.mean(axis=2)
+        estimate = np.array([[np.mean(estimates[method][metric]) for metric in METRICS] for method in methods])
+    method_as = accuracy_score(means, axis=1, rank_method=config['rank_method'])
+    summary = pd.DataFrame(index=methods)
+    for k, metric in enumerate(METRICS + ['AS']):
+        if metric == 'AS':
+            summary[metric] = accuracy_score(estimate, axis=0, rank_method=config['rank_method'])
+            values = method_as
+        else:
+            summary[metric] = estimate[:, k]
+            values = means[..., k]
+        summary[metric + '_low'], summary[metric + '_high'] = _interval(values, alpha)
+    return gene_results, summary
+
+
+def main(args):
+    result_dir = 'result/' + args.document
+    outdir = args.outdir or result_dir
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    gene_results, summary = bootstrap(result_dir, methods=args.methods, scheme=args.scheme, B=args.B,
+                                      resample_genes=args.resample_genes, alpha=args.alpha,
+                                      batch_size=args.batch_size, seed=args.seed)
+    for method, result in gene_results.items():
+        result.to_csv(os.path.join(outdir, f'{args.document}_{method}_gene_ci.csv'))
+    print(pd.DataFrame({metric: [f"{row[metric]:.3f} [{row[metric + '_low']:.3f}, {row[metric + '_high']:.3f}]"
+                                 for _, row in summary.iterrows()] for metric in METRICS + ['AS']},
+                       index=summary.index).to_string())
+    summary.to_csv(os.path.join(outdir, f'{args.document}_methods_ci.csv'))
+
+
+parser = argparse.ArgumentParser(description='bootstrap')
+parser.add_argument("--document", type=str, default='dataset45_ML')
+parser.add_argument("--methods", type=str, nargs='*', default=METHODS)
+parser.add_argument("--scheme", type=str, default='baseline', choices=list(SCHEMES))
+parser.add_argument("--B", type=int, default=1000)  # 重采样次数
+parser.add_argument("--resample_genes", action='store_true')  # 方法层面的统计同时对基因重采样
+parser.add_argument("--alpha", type=float, default=0.05)  # 1 - alpha 置信区间
+parser.add_argument("--batch_size", type=int, default=32)  # 每批的重采样次数
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--outdir", type=str, default=None)  # 默认写到 result/<document>/
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,168 @@
+"""一次运行内对所有方法的预测计算逐基因的 PCC / SSIM / RMSE / JS 和 AS
+
+ground truth 只读一次, 每个方法的所有基因用按列归约一次算完, --workers > 0 时各方法在进程池中并行.
+给定 --chunk_size 时改为分块读取 (见 streaming.py), 不需要把 ground truth 和预测完整地放进内存.
+在仓库根目录运行:
+
+    python -m calculate_metrics.evaluate --document dataset1_MG --workers 4
+"""
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from preprocess.metrics import column_pcc, column_ssim, column_rmse, column_js
+from calculate_metrics.streaming import FORMATS, read_genes, stream_scores
+
+METHODS = ['SpaDiT', 'Tangram', 'scVI', 'SpaGE', 'stPlus', 'SpaOTsc', 'novoSpaRc', 'SpatialScope', 'stDiff']
+METRICS = ['PCC', 'SSIM', 'RMSE', 'JS']
+# 排名方向: PCC / SSIM 越大越好, RMSE / JS 越小越好
+ASCENDING = {'PCC': False, 'SSIM': False, 'RMSE': True, 'JS': True}
+# baseline 与 cal_baseline.py 相同, as 与 cal_as.py 相同 (先 min-max 归一化, RMSE 加 1, 并列取平均排名)
+SCHEMES = {
+    'baseline': dict(normalize=False, rmse_offset=0., rank_method='min'),
+    'as': dict(normalize=True, rmse_offset=1., rank_method='average'),
+}
+
+
+def normalize_data(values):
+    # 每一列 min-max 归一化
+    vmin, vmax = values.min(axis=0), values.max(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (values - vmin) / (vmax - vmin)
+
+
+def score_genes(true_values, pred_values, genes, scheme='baseline'):
+    """对每个基因 (列) 计算 PCC / SSIM / RMSE / JS 以及它们的排名和 AS
+
+    Args:
+        true_values (np.ndarray): ground truth, 形状为 (spots, genes).
+        pred_values (np.ndarray): 预测, 行列与 true_values 对应.
+        genes: 基因名, 作为结果的行索引.
+        scheme (str, optional): SCHEMES 中的约定. Defaults to 'baseline'.
+
+    Returns:
+        pd.DataFrame: 列与 cal_baseline.py 输出的 *_gene_result.csv 相同
+    """
+    config = SCHEMES[scheme]
+    if config['normalize']:
+        true_values, pred_values = normalize_data(true_values), normalize_data(pred_values)
+    # 常数列的 PCC 为 nan, 有负值的列 JS 为 inf, 与 pearsonr / jensenshannon 相同
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = pd.DataFrame({'PCC': np.clip(column_pcc(true_values, pred_values), -1, 1),
+                               'SSIM': column_ssim(true_values, pred_values),
+                               'RMSE': column_rmse(true_values, pred_values) + config['rmse_offset'],
+                               'JS': column_js(true_values, pred_values, distance=True)}, index=genes)
+    return rank_genes(scores, scheme)
+
+
+def rank_genes(scores, scheme='baseline'):
+    # 在 PCC / SSIM / RMSE / JS 后面加上各自的排名和 AS
+    config = SCHEMES[scheme]
+    for metric in METRICS:
+        scores['Rank_' + metric] = scores[metric].rank(ascending=ASCENDING[metric], method=config['rank_method'])
+    scores['AS'] = scores[['Rank_' + metric for metric in METRICS]].sum(axis=1) / 4 / (scores.shape[0] - 1)
+    return scores
+
+
+def summarize(scores):
+    # 每个指标在所有基因上的 mean±std, 格式与 cal_as.py 的 *_final_result.csv 相同; 有 inf 时 std 为 nan
+    with np.errstate(invalid='ignore'):
+        return {metric: f"{np.mean(scores[metric]):.3f}±{np.std(scores[metric]):.3f}" for metric in METRICS + ['AS']}
+
+
+# 进程池中每个 worker 只接收一次 ground truth, 不随每个任务重复传输
+_truth = None
+
+
+def _init_truth(true_values, genes):
+    global _truth
+    _truth = (true_values, genes)
+
+
+def _score_method(method, pred_path, scheme, chunk_size=None):
+    if chunk_size:
+        true_path, genes = _truth
+        config = SCHEMES[scheme]
+        scores = stream_scores(true_path, pred_path, genes, normalize=config['normalize'],
+                               rmse_offset=config['rmse_offset'], chunk_size=chunk_size)
+        return method, rank_genes(scores, scheme)
+    true_values, genes = _truth
+    pred = pd.read_csv(pred_path, index_col=0)
+    if pred.shape[0] != true_values.shape[0]:
+        raise ValueError(f'{pred_path} has {pred.shape[0]} spots, expected {true_values.shape[0]}')
+    pred_values = pred[genes].to_numpy(dtype=float)
+    return method, score_genes(true_values, pred_values, genes, scheme)
+
+
+def _find_file(result_dir, name, chunk_size=None):
+    # 整体读取只支持 csv, 分块读取时依次查找 csv / parquet / npy
+    for ext in (FORMATS if chunk_size else ('.csv',)):
+        path = os.path.join(result_dir, name + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def evaluate(result_dir, methods=METHODS, scheme='baseline', workers=0, chunk_size=None):
+    """读取 result_dir 下的 original.csv 和 {method}_prediction.csv, 计算所有方法的逐基因指标
+
+    没有预测文件的方法会被跳过. chunk_size 不为 None 时每次只读 chunk_size 行, ground truth 和预测
+    也可以是 parquet 或 npy, 结果与整体读取相同.
+
+    Returns:
+        dict: {method: score_genes 返回的 DataFrame}, 顺序与 methods 相同
+    """
+    true_path = _find_file(result_dir, 'original', chunk_size)
+    if true_path is None:
+        raise FileNotFoundError(f'no ground truth original.* in {result_dir}')
+    if chunk_size:
+        # 各进程自己分块读取 ground truth, 只传路径
+        truth = (true_path, read_genes(true_path))
+    else:
+        truth = pd.read_csv(true_path, index_col=0)
+        truth = (truth.to_numpy(dtype=float), truth.columns)
+
+    tasks = []
+    for method in methods:
+        pred_path = _find_file(result_dir, f'{method}_prediction', chunk_size)
+        if pred_path is None:
+            print(f'no prediction for {method} in {result_dir}, skip')
+            continue
+        tasks.append((method, pred_path, scheme, chunk_size))
+    if workers:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_truth, initargs=truth) as pool:
+            results = pool.map(_score_method, *zip(*tasks)) if tasks else []
+            return dict(results)
+    _init_truth(*truth)
+    return dict(_score_method(*task) for task in tasks)
+
+
+def main(args):
+    result_dir = 'result/' + args.document
+    outdir = args.outdir or result_dir
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    results = evaluate(result_dir, methods=args.methods, scheme=args.scheme, workers=args.workers,
+                       chunk_size=args.chunk_size)
+
+    summary = {}
+    for method, scores in results.items():
+        scores.to_csv(os.path.join(outdir, f'{args.document}_{method}_gene_result.csv'))
+        summary[method] = summarize(scores)
+    summary = pd.DataFrame.from_dict(summary, orient='index')
+    print(summary)
+    summary.to_csv(os.path.join(outdir, f'{args.document}_methods_result.csv'), header=1, index=1)
+
+
+parser = argparse.ArgumentParser(description='metrics')
+parser.add_argument("--document", type=str, default='dataset45_ML')
+parser.add_argument("--methods", type=str, nargs='*', default=METHODS)
+parser.add_argument("--scheme", type=str, default='baseline', choices=list(SCHEMES))
+parser.add_argument("--workers", type=int, default=0)  # >0 时各方法在进程池中并行计算
+parser.add_argument("--outdir", type=str, default=None)  # 默认写到 result/<document>/
+parser.add_argument("--chunk_size", type=int, default=None)  # 分块读取的行数, 用于内存放不下的大数据集
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,164 @@
+"""分块读取 ground truth 和预测, 计算与 evaluate.score_genes 相同的逐基因 PCC / SSIM / RMSE / JS
+
+两个矩阵都不会完整地读进内存, 每次只保留对应的 chunk_size 行. 读取两遍:
+第一遍统计每个基因的 min / max / sum, 得到 min-max 归一化的参数和 JS 中概率分布的归一化常数;
+第二遍在 (归一化后的) 块上合并均值, 方差, 协方差, 差的平方和, 最大值以及 JS 的各项, 所有指标都是精确值.
+
+支持 csv (第一列为行索引), parquet (需要 pyarrow) 和 npy. npy 没有基因名, 按列的位置与 ground truth 对应.
+"""
+import os
+import itertools
+import numpy as np
+import pandas as pd
+from preprocess.metrics import column_rel_entr, ssim_from_moments
+
+FORMATS = ('.csv', '.parquet', '.npy')
+
+
+def read_genes(path):
+    # 只读表头得到基因名
+    ext = os.path.splitext(path)[1]
+    if ext == '.csv':
+        return pd.read_csv(path, index_col=0, nrows=0).columns
+    if ext == '.parquet':
+        import pyarrow.parquet as pq
+        schema = pq.ParquetFile(path).schema_arrow
+        # pandas 写出的行索引也是一列, 去掉
+        index_columns = [c for c in (schema.pandas_metadata or {}).get('index_columns', []) if isinstance(c, str)]
+        return pd.Index([name for name in schema.names if name not in index_columns])
+    if ext == '.npy':
+        return pd.Index([str(i) for i in range(np.load(path, mmap_mode='r').shape[1])])
+    raise ValueError(f'unsupported file type: {path}, expected one of {FORMATS}')
+
+
+def _rechunk(chunks, chunk_size):
+    # parquet 的 batch 会在 row group 边界截断, 重新拼成固定的行数, 保证两个文件的块逐行对应
+    buffer, rows = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        rows += len(chunk)
+        while rows >= chunk_size:
+            merged = np.concatenate(buffer)
+            yield merged[:chunk_size]
+            buffer, rows = [merged[chunk_size:]], rows - chunk_size
+    if rows:
+        yield np.concatenate(buffer)
+
+
+def iter_chunks(path, genes, chunk_size):
+    """按行分块读取, 每块是 (chunk_size, len(genes)) 的 float64 数组, 列顺序与 genes 相同"""
+    ext = os.path.splitext(path)[1]
+    if ext == '.csv':
+        chunks = (chunk[genes].to_numpy(dtype=float)
+                  for chunk in pd.read_csv(path, index_col=0, chunksize=chunk_size))
+    elif ext == '.parquet':
+        import pyarrow.parquet as pq
+        chunks = (batch.to_pandas()[genes].to_numpy(dtype=float)
+                  for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=list(genes)))
+    elif ext == '.npy':
+        values = np.load(path, mmap_mode='r')
+        if values.shape[1] != len(genes):
+            raise ValueError(f'{path} has {values.shape[1]} genes, expected {len(genes)}')
+        chunks = (np.asarray(values[start:start + chunk_size], dtype=float)
+                  for start in range(0, values.shape[0], chunk_size))
+    else:
+        raise ValueError(f'unsupported file type: {path}, expected one of {FORMATS}')
+    return _rechunk(chunks, chunk_size)
+
+
+def iter_pairs(true_path, pred_path, genes, chunk_size):
+    # ground truth 和预测逐块对应地读取
+    for true_chunk, pred_chunk in itertools.zip_longest(iter_chunks(true_path, genes, chunk_size),
+                                                        iter_chunks(pred_path, genes, chunk_size)):
+        if true_chunk is None or pred_chunk is None or len(true_chunk) != len(pred_chunk):
+            raise ValueError(f'{pred_path} and {true_path} have different numbers of spots')
+        yield true_chunk, pred_chunk
+
+
+class ColumnStats:
+    """逐块合并的每列统计量
+
+    均值, 平方和与协方差用 Chan 等人的两组合并公式更新, 数值上与一次算完相同.
+    scale 不为 None 时把每一列的 rel_entr 项按已知的归一化常数累加, 得到精确的 JS.
+    """
+
+    def __init__(self, num_genes):
+        self.n = 0
+        self.mean_a = np.zeros(num_genes)
+        self.mean_b = np.zeros(num_genes)
+        self.m2_a = np.zeros(num_genes)
+        self.m2_b = np.zeros(num_genes)
+        self.c_ab = np.zeros(num_genes)
+        self.sq_diff = np.zeros(num_genes)
+        self.max_a = np.full(num_genes, -np.inf)
+        self.max_b = np.full(num_genes, -np.inf)
+        self.rel_entr = np.zeros(num_genes)
+
+    def update(self, a, b, scale_a=None, scale_b=None):
+        n = len(a)
+        mean_a, mean_b = a.mean(axis=0), b.mean(axis=0)
+        da, db = a - mean_a, b - mean_b
+        total = self.n + n
+        delta_a, delta_b = mean_a - self.mean_a, mean_b - self.mean_b
+        weight = self.n * n / total
+        self.m2_a += np.einsum('ij,ij->j', da, da) + delta_a ** 2 * weight
+        self.m2_b += np.einsum('ij,ij->j', db, db) + delta_b ** 2 * weight
+        self.c_ab += np.einsum('ij,ij->j', da, db) + delta_a * delta_b * weight
+        self.mean_a += delta_a * n / total
+        self.mean_b += delta_b * n / total
+        self.n = total
+
+        diff = a - b
+        self.sq_diff += np.einsum('ij,ij->j', diff, diff)
+        self.max_a = np.maximum(self.max_a, a.max(axis=0))
+        self.max_b = np.maximum(self.max_b, b.max(axis=0))
+        if scale_a is not None:
+            p, q = a / scale_a, b / scale_b
+            m = (p + q) / 2
+            self.rel_entr += column_rel_entr(p, m) + column_rel_entr(q, m)
+
+
+def stream_scores(true_path, pred_path, genes, normalize=False, rmse_offset=0., chunk_size=10000):
+    """分两遍读取, 返回 PCC / SSIM / RMSE / JS, 与 evaluate.score_genes 相同参数下的前四列一致
+
+    Args:
+        genes: 参与计算的基因, 两个文件中按名字取列 (npy 按位置).
+        normalize (bool, optional): 是否先对每一列做 min-max 归一化. Defaults to False.
+        rmse_offset (float, optional): 加到 RMSE 上的常数. Defaults to 0.
+        chunk_size (int, optional): 每块的行数, 内存占用约为 2 * chunk_size * len(genes) 个 float64. Defaults to 10000.
+
+    Returns:
+        pd.DataFrame: 行为基因
+    """
+    num_genes = len(genes)
+    # 第一遍: min / max / sum
+    n = 0
+    min_a, min_b = np.full(num_genes, np.inf), np.full(num_genes, np.inf)
+    max_a, max_b = np.full(num_genes, -np.inf), np.full(num_genes, -np.inf)
+    sum_a, sum_b = np.zeros(num_genes), np.zeros(num_genes)
+    for a, b in iter_pairs(true_path, pred_path, genes, chunk_size):
+        n += len(a)
+        min_a, min_b = np.minimum(min_a, a.min(axis=0)), np.minimum(min_b, b.min(axis=0))
+        max_a, max_b = np.maximum(max_a, a.max(axis=0)), np.maximum(max_b, b.max(axis=0))
+        sum_a, sum_b = sum_a + a.sum(axis=0), sum_b + b.sum(axis=0)
+
+    # 第二遍: 在 (归一化后的) 值上累计各项
+    stats = ColumnStats(num_genes)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if normalize:
+            range_a, range_b = max_a - min_a, max_b - min_b
+            scale_a, scale_b = (sum_a - n * min_a) / range_a, (sum_b - n * min_b) / range_b
+        else:
+            scale_a, scale_b = sum_a, sum_b
+        for a, b in iter_pairs(true_path, pred_path, genes, chunk_size):
+            if normalize:
+                a, b = (a - min_a) / range_a, (b - min_b) / range_b
+            stats.update(a, b, scale_a, scale_b)
+
+        var_a, var_b, cov = stats.m2_a / n, stats.m2_b / n, stats.c_ab / n
+        M = np.maximum(stats.max_a, stats.max_b)
+        # 常数列的 PCC 为 nan, 有负值的列 JS 为 inf, 与 pearsonr / jensenshannon 相同
+        return pd.DataFrame({'PCC': np.clip(cov / np.sqrt(var_a * var_b), -1, 1),
+                             'SSIM': ssim_from_moments(stats.mean_a, stats.mean_b, var_a, var_b, cov, M),
+                             'RMSE': np.sqrt(stats.sq_diff / n) + rmse_offset,
+                             'JS': np.sqrt(stats.rel_entr / 2)}, index=genes)
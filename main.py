@@ -1,46 +1,22 @@
-import anndata as ad
-import numpy as np
-import pandas as pd
-import sys
-import pickle
 import os
-import datetime
-import time as tm
-from functools import partial
-import scipy.stats as st
-from scipy.stats import wasserstein_distance
-import scipy.stats
-import copy
-from sklearn.model_selection import KFold
-import pandas as pd
-import multiprocessing
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import scanpy as sc
-import warnings
-from scipy.stats import spearmanr, pearsonr
-from scipy.spatial import distance_matrix
-from sklearn.metrics import matthews_corrcoef
-from scipy import stats
-import seaborn as sns
-import torch
-from scipy.spatial.distance import cdist
-import h5py
-import time
 import sys
-import tangram as tg
-import pickle
 import yaml
 import argparse
-from os.path import join
-from IPython.display import display
+import pandas as pd
+import torch
 from model.diff_model import DiT_diff
 from model.diff_scheduler import NoiseScheduler
-from model.diff_train import normal_train_diff
-from model.sample import sample_diff
-from preprocess.result_analysis import clustering_metrics
-from preprocess.utils import *
-from preprocess.data import *
+from model.diff_train import normal_train_diff, distill_train_diff
+from model.sample import sample_diff, parallel_sample_diff
+from model.checkpoint import CheckpointManager, checkpoint_prefix
+from model.profiler import PhaseTimer
+from model.telemetry import build_sink
+from model.distributed import init_distributed
+import torch.distributed as dist
+from torch.utils.data.distributed import DistributedSampler
+from preprocess.utils import seed_everything, split_dataset_with_gene_names
+from preprocess.data import ConditionalDiffusionDataset
+from torch.utils.data import DataLoader
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -62,10 +38,32 @@ parser.add_argument("--head", type=int, default=16)
 parser.add_argument("--mask_nonzero_ratio", type=float, default=0.3)
 parser.add_argument("--mask_zero_ratio", type=float, default=0.1)
 parser.add_argument("--seed", type=int, default=3407)
-args = parser.parse_args()
-
-print(os.getcwd())
-print(torch.cuda.get_device_name(torch.cuda.current_device()))
+parser.add_argument("--mask_exact", action='store_true')  # 恰好 mask 给定比例, 默认按比例 Bernoulli 采样
+parser.add_argument("--distill_step", type=int, default=0)  # 0 表示不做渐进蒸馏, 否则必须整除 diffusion_step
+parser.add_argument("--distill_epoch", type=int, default=None)
+parser.add_argument("--workers", type=int, default=0)  # >0 时按基因分 shard 多进程采样
+parser.add_argument("--shard_size", type=int, default=256)
+parser.add_argument("--resume", action='store_true')  # 从最新的 checkpoint 继续训练
+parser.add_argument("--save_every", type=int, default=10)
+parser.add_argument("--keep_ckpt", type=int, default=3)
+parser.add_argument("--valid_every", type=int, default=0)  # >0 时每隔多少个 epoch 在验证集上算一次损失, 0 表示不做验证
+parser.add_argument("--patience", type=int, default=None)  # 验证损失连续不下降的次数, 不给则不提前停止, 需要 --valid_every
+parser.add_argument("--ema_decay", type=float, default=0)  # >0 时保存和采样使用参数的 EMA
+parser.add_argument("--ema_every", type=int, default=1)
+parser.add_argument("--accum_steps", type=int, default=1)  # 梯度累积, 有效 batch 为 batch_size * accum_steps * 进程数
+parser.add_argument("--warmup_steps", type=int, default=0)
+parser.add_argument("--lr_scaling", type=str, default='none', choices=['none', 'linear', 'sqrt'])
+parser.add_argument("--base_batch_size", type=int, default=64)  # learning_rate 对应的有效 batch 大小
+parser.add_argument("--timestep_sampler", type=str, default='uniform', choices=['uniform', 'loss_aware'])
+parser.add_argument("--warm_start", type=str, default=None)  # 其他数据集训练好的 .pt, 复制与 spot / cell 数无关的参数
+parser.add_argument("--finetune_epoch", type=int, default=None)  # warm start 时的训练 epoch 数, 不给则为 epoch
+parser.add_argument("--metric_every", type=int, default=1)  # 采样时每隔多少步计算一次 PCC / RMSE
+parser.add_argument("--tol", type=float, default=None)  # 采样提前终止: 基因的 x_0 相邻两步相对变化小于 tol 时停止
+parser.add_argument("--min_step", type=int, default=0)  # 提前终止前至少走的步数
+parser.add_argument("--profile", action='store_true')  # 统计训练 / 采样各阶段的耗时, 结束时打印汇总表
+parser.add_argument("--profile_trace", type=str, default=None)  # 用 torch.profiler 导出 chrome trace 的目录, 隐含 --profile
+# 训练 / 采样的吞吐等指标输出到 jsonl:<path> / tensorboard:<log_dir> / prometheus:<port>, 可以给多个
+parser.add_argument("--metrics", type=str, nargs='*', default=None)
 
 
 def train_valid_test():
@@ -79,7 +77,9 @@ def train_valid_test():
     if not os.path.exists(directory):
         os.makedirs(directory)
     # save_path = os.path.join(directory, f'{currt_time}.pt')
-    save_path = os.path.join(directory, args.document + '.pt')
+    # 文件名带上超参数的 hash, 改了配置不会误用旧的模型
+    prefix = checkpoint_prefix(vars(args))
+    save_path = os.path.join(directory, prefix + '.pt')
 
     dataset = ConditionalDiffusionDataset(sc_path, st_path)
     (train_dataset, train_gene_names), (valid_dataset, valid_gene_names), (
@@ -88,8 +88,14 @@ def train_valid_test():
 
     # all_data_matrix = torch.stack([data for data, _ in valid_dataset])
 
-    train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
-    valid_dataloader = DataLoader(valid_dataset, batch_size=args.batch_size, shuffle=True)
+    if dist.is_initialized():
+        # 每个进程只训练自己的一份基因, batch_size 是单个进程的 batch 大小
+        train_sampler = DistributedSampler(train_dataset, shuffle=True, seed=args.seed)
+        train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, sampler=train_sampler)
+    else:
+        train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
+    # 验证时固定顺序, 配合固定 seed 每次验证的加噪样本都相同
+    valid_dataloader = DataLoader(valid_dataset, batch_size=args.batch_size, shuffle=False)
     test_dataloader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False)
 
     cell_num = dataset.sc_data.shape[1]
@@ -111,30 +117,91 @@ def train_valid_test():
         dit_type='dit'
     )
 
+    num_epoch = args.epoch
+    if args.warm_start:
+        loaded = model.load_pretrained(torch.load(args.warm_start, map_location='cpu'))
+        print(f'warm start from {args.warm_start}: {len(loaded)}/{len(model.state_dict())} tensors')
+        num_epoch = args.finetune_epoch or args.epoch
+
     model.to(args.device)
     diffusion_step = args.diffusion_step
+    rank = dist.get_rank() if dist.is_initialized() else 0
+    world_size = dist.get_world_size() if dist.is_initialized() else 1
+    # 有效 batch 变大时按 linear / sqrt 规则放大学习率
+    lr_ratio = args.batch_size * args.accum_steps * world_size / args.base_batch_size
+    lr = args.learning_rate * {'none': 1., 'linear': lr_ratio, 'sqrt': lr_ratio ** 0.5}[args.lr_scaling]
+    if rank:
+        # 参数由 DDP 从 rank 0 广播, 各进程的加噪 / timestep 使用不同的随机数
+        seed_everything(args.seed + rank)
 
     model.train()
+    metrics_sink = build_sink(args.metrics) if rank == 0 else None
 
     if not os.path.isfile(save_path):
+        checkpoint_manager = CheckpointManager(os.path.join(directory, prefix + '_ckpt'), keep_last=args.keep_ckpt)
+        train_profiler = PhaseTimer('train', enabled=args.profile and rank == 0, device=args.device,
+                                    trace_dir=args.profile_trace)
         normal_train_diff(model,
                           dataloader=train_dataloader,
-                          lr=args.learning_rate,
-                          num_epoch=args.epoch,
+                          lr=lr,
+                          num_epoch=num_epoch,
                           diffusion_step=diffusion_step,
                           device=args.device,
                           pred_type='noise',
                           mask_nonzero_ratio=args.mask_nonzero_ratio,
-                          mask_zero_ratio=args.mask_zero_ratio)
-        torch.save(model.state_dict(), save_path)
+                          mask_zero_ratio=args.mask_zero_ratio,
+                          mask_exact=args.mask_exact,
+                          generator=torch.Generator(device=args.device).manual_seed(args.seed + rank),
+                          checkpoint_manager=checkpoint_manager,
+                          save_every=args.save_every,
+                          resume=args.resume,
+                          valid_dataloader=valid_dataloader if args.valid_every else None,
+                          valid_every=args.valid_every,
+                          patience=args.patience,
+                          ema_decay=args.ema_decay,
+                          ema_every=args.ema_every,
+                          accum_steps=args.accum_steps,
+                          warmup_steps=args.warmup_steps,
+                          timestep_sampler=args.timestep_sampler,
+                          profiler=train_profiler,
+                          metrics_sink=metrics_sink)
+        checkpoint_manager.close()
+        train_profiler.close()
+        if rank == 0:
+            torch.save(model.state_dict(), save_path)
     else:
         model.load_state_dict(torch.load(save_path))
 
+    if dist.is_initialized():
+        # 蒸馏和采样只在 rank 0 上单进程进行
+        dist.barrier()
+        dist.destroy_process_group()
+        if rank:
+            return None
+        # train_dataloader 的 DistributedSampler 只给出 1 / world_size 的基因, 单进程时改用完整的训练集
+        train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
+
     noise_scheduler = NoiseScheduler(
         num_timesteps=diffusion_step,
-        beta_schedule='cosine'
+        beta_schedule='cosine',
+        device=args.device
     )
 
+    if args.distill_step:
+        model, noise_scheduler = distill_train_diff(model,
+                                                    dataloader=train_dataloader,
+                                                    save_dir=directory,
+                                                    prefix=f'{prefix}_d{args.distill_epoch or args.epoch}',
+                                                    lr=args.learning_rate,
+                                                    num_epoch=args.distill_epoch or args.epoch,
+                                                    diffusion_step=diffusion_step,
+                                                    target_step=args.distill_step,
+                                                    device=args.device,
+                                                    pred_type='x_start',
+                                                    mask_nonzero_ratio=args.mask_nonzero_ratio,
+                                                    mask_zero_ratio=args.mask_zero_ratio)
+        diffusion_step = noise_scheduler.num_timesteps
+
     model.eval()
     # valid_gt = torch.stack([data for data, _ in valid_dataset])
     # imputation = sample_diff(model,
@@ -152,69 +219,112 @@ def train_valid_test():
     #                          omega=0.9
     #                          )
 
+    test_gt = torch.stack([data for data, t, _ in test_dataset])
+    test_sc = torch.stack([t for data, t, _ in test_dataset])
+    sample_kwargs = dict(mask_nonzero_ratio=0.3,
+                         mask_zero_ratio=0,
+                         num_step=diffusion_step,
+                         is_condi=True,
+                         sample_intermediate=diffusion_step,
+                         model_pred_type='x_start',
+                         is_classifier_guidance=False,
+                         omega=0.9,
+                         is_ddim=bool(args.distill_step),
+                         tol=args.tol,
+                         min_step=args.min_step)
     with torch.no_grad():
-       test_gt = torch.stack([data for data, t, _ in test_dataset])
-       test_sc = torch.stack([t for data, t, _ in test_dataset])
-       # test_gt = torch.randn(len(test_dataset), 249)
-       prediction = sample_diff(model,
-                                device=args.device,
-                                dataloader=test_dataloader,
-                                noise_scheduler=noise_scheduler,
-                                mask_nonzero_ratio=0.3,
-                                mask_zero_ratio = 0,
-                                gt=test_gt,
-                                sc=test_sc,
-                                num_step=diffusion_step,
-                                sample_shape=(test_gt.shape[0], test_gt.shape[1]),
-                                is_condi=True,
-                                sample_intermediate=diffusion_step,
-                                model_pred_type='x_start',
-                                is_classifier_guidance=False,
-                                omega=0.9
-                                )
+       if args.workers:
+           prediction = parallel_sample_diff(model,
+                                             dataset=dataset,
+                                             indices=test_dataset.indices,
+                                             noise_scheduler=noise_scheduler,
+                                             workers=args.workers,
+                                             shard_size=args.shard_size,
+                                             seed=args.seed,
+                                             batch_size=args.batch_size,
+                                             device=args.device,
+                                             is_tqdm=False,
+                                             **sample_kwargs)
+       else:
+           # test_gt = torch.randn(len(test_dataset), 249)
+           sample_profiler = PhaseTimer('sample', enabled=args.profile, device=args.device,
+                                        trace_dir=args.profile_trace)
+           prediction = sample_diff(model,
+                                    device=args.device,
+                                    dataloader=test_dataloader,
+                                    noise_scheduler=noise_scheduler,
+                                    gt=test_gt,
+                                    sc=test_sc,
+                                    sample_shape=(test_gt.shape[0], test_gt.shape[1]),
+                                    metric_every=args.metric_every,
+                                    profiler=sample_profiler,
+                                    metrics_sink=metrics_sink,
+                                    **sample_kwargs
+                                    )
+           sample_profiler.close()
+    if metrics_sink is not None:
+        metrics_sink.close()
 
     return prediction, test_gt, test_gene_names
 
 
 
-Data =  args.document
-outdir = 'result/' + Data +'/'
-if not os.path.exists(outdir):
-    os.makedirs(outdir)
-
-hyper_directory = 'save/'+Data+'_ckpt/'+Data+'_hyper/'
-hyper_file = Data + '_hyperameters.yaml'
-hyper_full_path = os.path.join(hyper_directory, hyper_file)
-if not os.path.exists(hyper_directory):
-    os.makedirs(hyper_directory)
-args_dict = vars(args)
-with open(hyper_full_path, 'w') as yaml_file:
-    yaml.dump(args_dict, yaml_file)
-
-prediction_result, ground_truth, test_gene_num = train_valid_test()
-# st_common_gene = pd.read_csv('datasets/' + Data + '/gene/common_genes.csv').iloc[:, 0].tolist()
-# st_unique_gene = pd.read_csv('datasets/' + Data +'/gene/unique_to_st.csv').iloc[:, 0].tolist()
-# gene_name = st_common_gene + st_unique_gene
-
-gene_name = test_gene_num
-prediction_result = prediction_result.T
-ground_truth = ground_truth.numpy().T
-pred_result = pd.DataFrame(prediction_result, columns=[gene_name])
-original = pd.DataFrame(ground_truth, columns=[gene_name])
-pred_result.to_csv(outdir + '/SpaDiT_prediction.csv', header=True, index=True)
-original.to_csv(outdir + '/original.csv', header=True, index=True)
-
-
-# prediction_result, ground_truth = train_valid_test()
-# st_common_gene = pd.read_csv("D:/OSC.csv", header=0).iloc[:, 1:].columns
-# st_unique_gene = pd.read_csv("D:/OSC.csv", header=0).iloc[:, 1:].columns
-# gene_name = st_common_gene + st_unique_gene
-# pred_result = pd.DataFrame(prediction_result, columns=[gene_name])
-# original = pd.DataFrame(ground_truth.numpy(), columns=[gene_name])
-# pred_result.to_csv(outdir + '/SpaDiT_prediction.csv', header=True, index=True)
-# original.to_csv(outdir + '/original.csv', header=True, index=True)
-
-#
-# pred_result = pd.DataFrame(pred, columns=[st_common_gene+st_unique_gene])
-#
-# print(pred_result)
\ No newline at end of file
+if __name__ == "__main__":
+    # spawn 出来的采样子进程会重新 import 本文件, 脚本部分只在主进程执行
+    args = parser.parse_args()
+    if args.patience is not None and not args.valid_every:
+        parser.error('--patience requires --valid_every > 0')
+    # trace 由 PhaseTimer 记录, 只在计时开启时生效
+    args.profile = args.profile or args.profile_trace is not None
+    # torchrun --nproc_per_node N main.py ... 启动时初始化进程组, 每个进程使用自己的 device
+    rank, world_size, args.device = init_distributed(args.device)
+
+    print(os.getcwd())
+    if torch.cuda.is_available():
+        print(torch.cuda.get_device_name(torch.cuda.current_device()))
+
+    Data =  args.document
+    outdir = 'result/' + Data +'/'
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    hyper_directory = 'save/'+Data+'_ckpt/'+Data+'_hyper/'
+    hyper_file = Data + '_hyperameters.yaml'
+    hyper_full_path = os.path.join(hyper_directory, hyper_file)
+    if not os.path.exists(hyper_directory):
+        os.makedirs(hyper_directory)
+    args_dict = vars(args)
+    if rank == 0:
+        with open(hyper_full_path, 'w') as yaml_file:
+            yaml.dump(args_dict, yaml_file)
+
+    result = train_valid_test()
+    if result is None:
+        sys.exit(0)
+    prediction_result, ground_truth, test_gene_num = result
+    # st_common_gene = pd.read_csv('datasets/' + Data + '/gene/common_genes.csv').iloc[:, 0].tolist()
+    # st_unique_gene = pd.read_csv('datasets/' + Data +'/gene/unique_to_st.csv').iloc[:, 0].tolist()
+    # gene_name = st_common_gene + st_unique_gene
+
+    gene_name = test_gene_num
+    prediction_result = prediction_result.T
+    ground_truth = ground_truth.numpy().T
+    pred_result = pd.DataFrame(prediction_result, columns=[gene_name])
+    original = pd.DataFrame(ground_truth, columns=[gene_name])
+    pred_result.to_csv(outdir + '/SpaDiT_prediction.csv', header=True, index=True)
+    original.to_csv(outdir + '/original.csv', header=True, index=True)
+
+
+    # prediction_result, ground_truth = train_valid_test()
+    # st_common_gene = pd.read_csv("D:/OSC.csv", header=0).iloc[:, 1:].columns
+    # st_unique_gene = pd.read_csv("D:/OSC.csv", header=0).iloc[:, 1:].columns
+    # gene_name = st_common_gene + st_unique_gene
+    # pred_result = pd.DataFrame(prediction_result, columns=[gene_name])
+    # original = pd.DataFrame(ground_truth.numpy(), columns=[gene_name])
+    # pred_result.to_csv(outdir + '/SpaDiT_prediction.csv', header=True, index=True)
+    # original.to_csv(outdir + '/original.csv', header=True, index=True)
+
+    #
+    # pred_result = pd.DataFrame(pred, columns=[st_common_gene+st_unique_gene])
+    #
+    # print(pred_result)
\ No newline at end of file
@@ -0,0 +1,136 @@
+import os
+import glob
+import json
+import queue
+import random
+import hashlib
+import threading
+import numpy as np
+import torch
+
+# 只影响运行方式、不影响训练出来的模型的参数, 不参与 hash
+RUNTIME_ARGS = ('device', 'resume', 'save_every', 'keep_ckpt', 'workers', 'shard_size', 'distill_step',
+                'distill_epoch', 'metric_every', 'profile', 'profile_trace', 'metrics', 'tol', 'min_step',
+                'valid_every')
+
+
+def hyper_hash(hyper, exclude=RUNTIME_ARGS):
+    """超参数的 hash, 用来区分不同配置训练出来的 checkpoint"""
+    items = {k: v for k, v in hyper.items() if k not in exclude}
+    return hashlib.sha1(json.dumps(items, sort_keys=True, default=str).encode()).hexdigest()[:10]
+
+
+def checkpoint_prefix(hyper):
+    # save/<doc>_ckpt/<doc>_scdiff/ 下的文件名前缀
+    return hyper['document'] + '_' + hyper_hash(hyper)
+
+
+def get_rng_state():
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _to_cpu(obj):
+    # 先拷贝到 cpu, 后台线程写文件的同时训练可以继续修改参数
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+class CheckpointManager:
+    """在后台线程中保存训练状态, 只保留最新的 keep_last 个
+
+    每个 checkpoint 先写到 .tmp 文件再 os.replace, 中途被杀掉也不会留下损坏的文件.
+
+    Args:
+        directory (str): checkpoint 的保存目录.
+        keep_last (int, optional): 保留的 checkpoint 个数. Defaults to 3.
+        prefix (str, optional): 文件名前缀, 文件为 {prefix}_{epoch}.pt. Defaults to 'ckpt'.
+    """
+
+    def __init__(self, directory, keep_last=3, prefix='ckpt'):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.prefix = prefix
+        self.error = None
+        os.makedirs(directory, exist_ok=True)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _path(self, epoch):
+        return os.path.join(self.directory, f'{self.prefix}_{epoch:06d}.pt')
+
+    def _checkpoints(self):
+        return sorted(glob.glob(os.path.join(self.directory, f'{self.prefix}_[0-9]*.pt')))
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                epoch, state = item
+                path = self._path(epoch)
+                torch.save(state, path + '.tmp')
+                os.replace(path + '.tmp', path)
+                for old in self._checkpoints()[:-self.keep_last]:
+                    os.remove(old)
+            except Exception as e:
+                self.error = e
+            finally:
+                self._queue.task_done()
+
+    def save(self, state, epoch):
+        self._raise_error()
+        self._queue.put((epoch, _to_cpu(state)))
+
+    def clear(self):
+        """删除这个前缀的所有 checkpoint
+
+        保留时按文件名中的 epoch 排序, 不 resume 而重新训练时需要先删除上一次留下的 epoch 更大的 checkpoint,
+        否则新保存的 checkpoint 会被立即删掉, 之后的 resume 也会从旧的状态继续.
+        """
+        self.wait()
+        for path in self._checkpoints():
+            os.remove(path)
+
+    def latest(self):
+        checkpoints = self._checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def load_latest(self, map_location=None):
+        path = self.latest()
+        if path is None:
+            return None
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+    def wait(self):
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
@@ -3,7 +3,6 @@ import torch.nn as nn
 import numpy as np
 import math
 import einops
-from timm.models.vision_transformer import PatchEmbed, Attention, Mlp
 import sys
 import torch.nn.functional as F
 from preprocess.utils import pca_with_torch
@@ -22,6 +21,23 @@ class SimpleMLP(nn.Module):
         x = self.fc3(x)
         return x
 
+class Mlp(nn.Module):
+    # 与 timm.models.vision_transformer.Mlp 的结构和参数名相同, 导入 timm 要好几秒
+    def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
+        super().__init__()
+        out_features = out_features or in_features
+        hidden_features = hidden_features or in_features
+        self.fc1 = nn.Linear(in_features, hidden_features)
+        self.act = act_layer()
+        self.drop1 = nn.Dropout(drop)
+        self.norm = nn.Identity()
+        self.fc2 = nn.Linear(hidden_features, out_features)
+        self.drop2 = nn.Dropout(drop)
+
+    def forward(self, x):
+        x = self.drop1(self.act(self.fc1(x)))
+        return self.drop2(self.fc2(self.norm(x)))
+
 class SelfAttention2(nn.Module):
     def __init__(self, feature_dim, hidden_size):
         super(SelfAttention2, self).__init__()
@@ -284,6 +300,10 @@ class UNet(nn.Module):
 
 
 class DiT_diff(nn.Module):
+    # 维度取决于 spot 数或 cell 数的输入 / 输出层, 换数据集 warm start 时重新初始化
+    io_layers = ('in_layer.', 'x_in_layer.', 'cond_layer.', 'cond_layer_atten.', 'cond_layer_mlp.fc1.',
+                 'unet.decoder.4.', 'out_layer.linear.')
+
     def __init__(self,
                  st_input_size,
                  condi_input_size,
@@ -370,6 +390,21 @@ class DiT_diff(nn.Module):
         nn.init.constant_(self.out_layer.linear.weight, 0)
         nn.init.constant_(self.out_layer.linear.bias, 0)
 
+    def load_pretrained(self, state_dict):
+        """用其他数据集上训练的参数 warm start
+
+        只复制不在 io_layers 中且形状相同的参数 (unet 主体, time_emb, condition MLP 主体等),
+        输入 / 输出层保持当前的初始化.
+
+        Returns:
+            list: 复制了的参数名
+        """
+        own_state = self.state_dict()
+        state_dict = {k: v for k, v in state_dict.items()
+                      if k in own_state and not k.startswith(self.io_layers) and v.shape == own_state[k].shape}
+        self.load_state_dict(state_dict, strict=False)
+        return sorted(state_dict)
+
     def forward(self, x, x_hat, t, y, **kwargs):
         x = x.float()
         x_hat = x_hat.float()
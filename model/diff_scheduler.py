@@ -1,5 +1,4 @@
 import torch
-import matplotlib.pyplot as plt
 from torch.nn import functional as F
 import numpy as np
 import math
@@ -32,9 +31,15 @@ class NoiseScheduler():
                  beta_start=0.0001,
                  beta_end=0.02,
                  beta_schedule="linear",
+                 timestep_stride=1,
                  device=torch.device('cuda:0')):
         # 总的前向 diffusion step
         self.num_timesteps = num_timesteps
+        self.beta_start = beta_start
+        self.beta_end = beta_end
+        self.beta_schedule = beta_schedule
+        # 蒸馏后的 scheduler 每一步对应原始 scheduler 的 timestep_stride 步
+        self.timestep_stride = timestep_stride
 
         if beta_schedule == "linear":
             self.betas = torch.linspace(
@@ -142,6 +147,41 @@ class NoiseScheduler():
 
         return pred_prev_sample, pred_original_sample  # imputation时候需要后面的
 
+    def ddim_step(self,
+                  model_output,
+                  timestep,
+                  sample,
+                  model_pred_type: str = 'noise'):
+        # 确定性的 DDIM 逆扩散一步 (eta=0)，渐进蒸馏的 teacher/student 都用这个
+        t = timestep
+        s1 = self.sqrt_alphas_cumprod[t].reshape(-1, 1).to(sample.device)
+        s2 = self.sqrt_one_minus_alphas_cumprod[t].reshape(-1, 1).to(sample.device)
+
+        if model_pred_type == 'noise':
+            pred_original_sample = self.reconstruct_x0(sample, t, model_output)
+            pred_noise = model_output
+        elif model_pred_type == 'x_start':
+            pred_original_sample = model_output
+            pred_noise = (sample - s1 * pred_original_sample) / s2
+        else:
+            raise NotImplementedError()
+
+        alpha_prev = self.alphas_cumprod_prev[t].reshape(-1, 1).to(sample.device)
+        pred_prev_sample = alpha_prev ** 0.5 * pred_original_sample + (1. - alpha_prev) ** 0.5 * pred_noise
+        return pred_prev_sample, pred_original_sample
+
+    def model_timestep(self, t):
+        # 将本 scheduler 的 timestep 映射回模型训练时的 timestep
+        # cosine schedule 下 N/2 步的第 k 步与 N 步的第 2k+1 步的 alpha_bar 相同
+        return (t + 1) * self.timestep_stride - 1
+
+    def config(self):
+        return {'num_timesteps': self.num_timesteps,
+                'beta_start': self.beta_start,
+                'beta_end': self.beta_end,
+                'beta_schedule': self.beta_schedule,
+                'timestep_stride': self.timestep_stride}
+
     def add_noise(self, x_start, x_noise, timesteps):  # 正向加噪的过程
         # 输入 x_0,noise,t 来得到 x_t
         # print(x_start.device)
@@ -152,6 +192,18 @@ class NoiseScheduler():
         s2 = s2.reshape(-1, 1).to(x_start.device)
         return s1 * x_start + s2 * x_noise
 
+    def add_noise_(self, x_start, mask, timesteps, noise=None):
+        # 只在 mask 的位置原地加噪, 不生成稠密的 noise 和 x_t
+        # 返回这些位置上的噪声, 顺序与 x_start[mask] 相同
+        rows, cols = mask.nonzero(as_tuple=True)
+        if noise is None:
+            noise = torch.randn(rows.shape[0], dtype=x_start.dtype, device=x_start.device)
+        t = timesteps[rows]
+        s1 = self.sqrt_alphas_cumprod[t].to(x_start.device)
+        s2 = self.sqrt_one_minus_alphas_cumprod[t].to(x_start.device)
+        x_start[rows, cols] = s1 * x_start[rows, cols] + s2 * noise
+        return noise
+
     def undo(self, image_before_step, img_after_model, est_x_0, t, debug=False):
         # 对x_t加噪
         return self._undo(img_after_model, t)
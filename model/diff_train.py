@@ -1,51 +1,105 @@
 import torch
 import numpy as np
 import os
+import copy
+import math
+import contextlib
+import yaml
 import torch.nn as nn
 from tqdm import tqdm
 from torch.utils.data import TensorDataset, DataLoader
 from einops import rearrange, repeat
 
-import ray
-from ray import tune
-from ray.air import session
-from ray.tune.schedulers import ASHAScheduler
-from ray.tune.search.optuna import OptunaSearch
 import sys
 import os
-from torch.optim.lr_scheduler import StepLR
+from torch.optim.lr_scheduler import StepLR, LambdaLR
 
 from .diff_scheduler import NoiseScheduler
-from preprocess.utils import mask_tensor_with_masks
+from .checkpoint import get_rng_state, set_rng_state
+from .ema import EMA
+from .resample import LossSecondMomentSampler
+from .profiler import PhaseTimer
+from .telemetry import StepMeter, resource_metrics
+from .distributed import is_distributed, get_rank, all_reduce_mean, broadcast_object, all_gather_object
+from torch.nn.parallel import DistributedDataParallel
+from preprocess.utils import MaskGenerator
 import torch.nn.functional as F
 
 
 
-class HuberLoss(nn.Module):
-    def __init__(self, delta=1.0):
-        super(HuberLoss, self).__init__()
-        self.delta = delta
-
-    def forward(self, input, target):
-        abs_error = torch.abs(input - target)
-        is_small_error = abs_error <= self.delta
-        small_error_loss = 0.5 * abs_error ** 2
-        large_error_loss = self.delta * abs_error - 0.5 * self.delta ** 2
-        return torch.where(is_small_error, small_error_loss, large_error_loss).mean()
+class masked_diffusion_loss(nn.Module):
+    """mask 为 0 的位置上的 MSE 加上 mask 为 1 的位置上的 Huber 损失, 输入只是被 mask 位置上的值
 
-class diffusion_loss(nn.Module):
+    等价于 MSE(x * m0, y * m0) + Huber(x * m1, y * m1) 在完整张量上取平均: 未被 mask 的位置误差都为 0,
+    所以只需要在 mask 的位置上求和, 再除以完整张量的元素个数 numel
+    """
     def __init__(self, penalty_factor=1.0, delta=1.0):
-        super(diffusion_loss, self).__init__()
-        self.mse = nn.MSELoss()
-        self.huber_loss = HuberLoss(delta=delta)
+        super(masked_diffusion_loss, self).__init__()
         self.penalty_factor = penalty_factor
+        self.delta = delta
 
-    def forward(self, y_pred_0, y_true_0, y_pred_1, y_true_1):
-        loss_mse = self.mse(y_pred_0, y_true_0)
-        loss_huber = self.huber_loss(y_pred_1, y_true_1) * self.penalty_factor  # 计算 Huber 损失
+    def forward(self, y_pred_0, y_true_0, y_pred_1, y_true_1, numel):
+        loss_mse = F.mse_loss(y_pred_0, y_true_0, reduction='sum') / numel
+        loss_huber = F.huber_loss(y_pred_1, y_true_1, reduction='sum', delta=self.delta) / numel * self.penalty_factor
         return loss_mse + loss_huber
 
+    def per_sample(self, y_pred_0, y_true_0, rows_0, y_pred_1, y_true_1, rows_1, batch_size, row_numel):
+        """每个样本 (行) 的损失, 按行求和后除以每行的元素个数, 对 batch 取平均即为 forward 的结果
+
+        rows_0 / rows_1 是 mask 位置所在的行号, 与 y_pred_0 / y_pred_1 一一对应.
+        """
+        loss = torch.zeros(batch_size, dtype=y_pred_0.dtype, device=y_pred_0.device)
+        loss.index_add_(0, rows_0, F.mse_loss(y_pred_0, y_true_0, reduction='none'))
+        loss.index_add_(0, rows_1, F.huber_loss(y_pred_1, y_true_1, reduction='none', delta=self.delta)
+                        * self.penalty_factor)
+        return loss / row_numel
+
+
+@torch.no_grad()
+def valid_diff(model,
+               dataloader,
+               noise_scheduler,
+               diffusion_step: int = 1000,
+               device=torch.device('cuda:0'),
+               mask_nonzero_ratio=None,
+               mask_zero_ratio=None,
+               seed: int = 0):
+    """验证集上的单步去噪损失
+
+    mask / timestep / 噪声都由固定 seed 的 generator 产生, 每次验证看到的是同一批加噪样本,
+    不同 epoch 之间的损失可以直接比较.
+
+    Returns:
+        float: 按基因数加权平均的损失
+    """
+    generator = torch.Generator(device=device).manual_seed(seed)
+    x_masker = MaskGenerator(mask_nonzero_ratio, mask_zero_ratio, generator=generator)
+    x_hat_masker = MaskGenerator(mask_nonzero_ratio, mask_zero_ratio, generator=generator)
+    criterion = masked_diffusion_loss()
+
+    is_training = model.training
+    model.eval()
+    total_loss, total_num = 0., 0
+    for x, x_hat, x_cond in dataloader:
+        x, x_hat, x_cond = x.float().to(device), x_hat.float().to(device), x_cond.float().to(device)
+        x, x_nonzero_mask, x_zero_mask = x_masker(x)
+        x_hat, x_hat_nonzero_mask, _ = x_hat_masker(x_hat)
+
+        timesteps = torch.randint(1, diffusion_step, (x.shape[0],), generator=generator, device=device)
+        x_noise = torch.randn(int(x_nonzero_mask.sum()), generator=generator, device=device)
+        noise_scheduler.add_noise_(x, x_nonzero_mask, timesteps=timesteps, noise=x_noise)
+        x_hat_noise = torch.randn(int(x_hat_nonzero_mask.sum()), generator=generator, device=device)
+        noise_scheduler.add_noise_(x_hat, x_hat_nonzero_mask, timesteps=timesteps, noise=x_hat_noise)
 
+        noise_pred = model(x, x_hat, t=timesteps, y=x_cond)
+        noise_pred_zero = noise_pred[x_zero_mask]
+        zero_noise = torch.randn(noise_pred_zero.shape, generator=generator, device=device)
+        loss = criterion(noise_pred[x_nonzero_mask], x_noise, noise_pred_zero, zero_noise,
+                         numel=noise_pred.numel())
+        total_loss += loss.item() * x.shape[0]
+        total_num += x.shape[0]
+    model.train(is_training)
+    return total_loss / total_num
 
 
 def normal_train_diff(model,
@@ -58,7 +112,23 @@ def normal_train_diff(model,
                  is_tqdm: bool = True,
                  is_tune: bool = False,
                  mask_nonzero_ratio= None,
-                 mask_zero_ratio = None):
+                 mask_zero_ratio = None,
+                 mask_exact: bool = False,
+                 generator=None,
+                 checkpoint_manager=None,
+                 save_every: int = 1,
+                 resume: bool = False,
+                 valid_dataloader=None,
+                 valid_every: int = 1,
+                 valid_mask_ratios=None,
+                 patience: int = None,
+                 ema_decay: float = 0.,
+                 ema_every: int = 1,
+                 accum_steps: int = 1,
+                 warmup_steps: int = 0,
+                 timestep_sampler: str = 'uniform',
+                 profiler=None,
+                 metrics_sink=None):
     """通用训练函数
 
     Args:
@@ -73,6 +143,31 @@ def normal_train_diff(model,
         is_tqdm (bool, optional): 开启进度条. Defaults to True.
         is_tune (bool, optional): 是否用 ray tune. Defaults to False.
         condi_drop_rate (float, optional): 是否采用 classifier free guidance 设置 drop rate. Defaults to 0..
+        mask_exact (bool, optional): 每次恰好 mask 给定比例的位置, 否则按比例做 Bernoulli 采样. Defaults to False.
+        generator (torch.Generator, optional): mask 使用的随机数生成器. Defaults to None.
+        checkpoint_manager (CheckpointManager, optional): 每 save_every 个 epoch 保存一次完整的训练状态. Defaults to None.
+        save_every (int, optional): 保存 checkpoint 的间隔 epoch 数. Defaults to 1.
+        resume (bool, optional): 从 checkpoint_manager 中最新的 checkpoint 恢复训练, 否则先删除其中已有的
+            checkpoint. Defaults to False.
+        valid_dataloader (DataLoader, optional): 每 valid_every 个 epoch 计算一次验证集上的单步去噪损失,
+            训练结束时 model 恢复为验证损失最低的参数. Defaults to None.
+        valid_every (int, optional): 验证的间隔 epoch 数. Defaults to 1.
+        valid_mask_ratios (tuple, optional): 验证时的 (mask_nonzero_ratio, mask_zero_ratio). 损失只在被 mask 的位置上
+            求和, mask 比例越小损失越小, 比较不同 mask 比例训练出来的模型时要固定. Defaults to None, 与训练时相同.
+        patience (int, optional): 连续 patience 次验证没有改善就提前停止, None 表示不提前停止. Defaults to None.
+        ema_decay (float, optional): 参数 EMA 的衰减系数, 大于 0 时验证和最终的 model 都使用 EMA 参数. Defaults to 0..
+        ema_every (int, optional): EMA 的更新间隔 step 数. Defaults to 1.
+        accum_steps (int, optional): 梯度累积的 batch 数, 有效 batch 大小为 batch_size * accum_steps. Defaults to 1.
+        warmup_steps (int, optional): 学习率从 0 线性增加到 lr 的优化器 step 数. Defaults to 0.
+        timestep_sampler (str, optional): 'uniform' 均匀采样 timestep; 'loss_aware' 按各 timestep 的历史 loss
+            做重要性采样, 并用 1 / (T * p_t) 对每个样本的 loss 加权. Defaults to 'uniform'.
+        profiler (PhaseTimer, optional): 记录各阶段耗时 (以及 chrome trace), 由调用方 close 输出汇总. Defaults to None.
+        metrics_sink (MetricsSink, optional): 每个 epoch 输出 loss, 学习率, 吞吐 (单个进程), 每步延迟的分位数
+            以及峰值内存 / 显存. Defaults to None.
+
+    学习率按优化器 step 调整: 先 warmup, 之后与原来的 StepLR 一样每 100 个 epoch 衰减为 0.1 倍.
+    进程组已初始化 (torchrun) 时 model 用 DistributedDataParallel 包装, dataloader 应使用 DistributedSampler;
+    各进程的学习率同步步进, 验证和 checkpoint 只在 rank 0 上进行, 提前停止的决定广播到所有进程.
 
     Raises:
         NotImplementedError: _description_
@@ -80,57 +175,356 @@ def normal_train_diff(model,
 
     noise_scheduler = NoiseScheduler(
         num_timesteps=diffusion_step,
-        beta_schedule='cosine'
+        beta_schedule='cosine',
+        device=device
     )
+    valid_mask_nonzero_ratio, valid_mask_zero_ratio = valid_mask_ratios or (mask_nonzero_ratio, mask_zero_ratio)
 
-    criterion = diffusion_loss()
+    criterion = masked_diffusion_loss()
     # criterion = nn.MSELoss()
     model.to(device)
+    if profiler is None:
+        profiler = PhaseTimer('train')
+    rank = get_rank()
+    meter = StepMeter(device, enabled=metrics_sink is not None and rank == 0)
+    is_tqdm = is_tqdm and rank == 0
+    train_model = model
+    if is_distributed():
+        # 构造时会把 rank 0 的参数广播到所有进程; 条件分支的参数不参与 loss, 需要 find_unused_parameters
+        train_model = DistributedDataParallel(model,
+                                              device_ids=[device] if str(device).startswith('cuda') else None,
+                                              find_unused_parameters=True)
 
     optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=0)
-    scheduler = StepLR(optimizer, step_size=100, gamma=0.1)
+    steps_per_epoch = math.ceil(len(dataloader) / accum_steps)
+
+    def lr_lambda(step):
+        warmup = min(1., (step + 1) / warmup_steps) if warmup_steps > 0 else 1.
+        return warmup * 0.1 ** (step // steps_per_epoch // 100)
+
+    scheduler = LambdaLR(optimizer, lr_lambda)
+    x_masker = MaskGenerator(mask_nonzero_ratio, mask_zero_ratio, exact=mask_exact, generator=generator)
+    x_hat_masker = MaskGenerator(mask_nonzero_ratio, mask_zero_ratio, exact=mask_exact, generator=generator)
+    ema = EMA(model, decay=ema_decay, every=ema_every) if ema_decay > 0 else None
+    if timestep_sampler == 'loss_aware':
+        timestep_sampler = LossSecondMomentSampler(diffusion_step)
+    elif timestep_sampler == 'uniform':
+        timestep_sampler = None
+    else:
+        raise NotImplementedError(f'unknown timestep_sampler: {timestep_sampler}')
+    # 验证和最终保存的都是 EMA 参数
+    eval_model = ema.module if ema is not None else model
+
+    start_epoch = 0
+    # 验证损失最低时的参数, 以及验证损失连续没有下降的次数
+    best_loss, best_model, bad_valid = float('inf'), None, 0
+    valid_loss = None
+    if not resume and checkpoint_manager is not None and rank == 0:
+        # 重新训练, 删除同一配置之前留下的 checkpoint
+        checkpoint_manager.clear()
+    if resume and checkpoint_manager is not None:
+        state = checkpoint_manager.load_latest(map_location=device)
+        if state is not None:
+            model.load_state_dict(state['model'])
+            optimizer.load_state_dict(state['optimizer'])
+            scheduler.load_state_dict(state['scheduler'])
+            # 多进程训练时每个进程的随机数状态分别保存
+            rng, generator_state = state['rng'], state['generator']
+            if isinstance(rng, list):
+                rng, generator_state = rng[rank], generator_state[rank]
+            set_rng_state(rng)
+            if generator is not None:
+                generator.set_state(generator_state.cpu())
+            if ema is not None:
+                ema.load_state_dict(state['ema'])
+            if timestep_sampler is not None:
+                timestep_sampler.load_state_dict(state['timestep_sampler'])
+            start_epoch = state['epoch']
+            best_loss, best_model, bad_valid = state.get('best_loss', best_loss), state.get('best_model'), \
+                state.get('bad_valid', 0)
 
     if is_tqdm:
-        t_epoch = tqdm(range(num_epoch), ncols=100)
+        t_epoch = tqdm(range(start_epoch, num_epoch), ncols=100)
     else:
-        t_epoch = range(num_epoch)
+        t_epoch = range(start_epoch, num_epoch)
 
     model.train()
 
     for epoch in t_epoch:
         epoch_loss = 0.
-        for i, (x, x_hat, x_cond) in enumerate(dataloader): # 去掉了, celltype
-            x, x_hat, x_cond = x.float().to(device), x_hat.float().to(device),x_cond.float().to(device)
+        if hasattr(dataloader.sampler, 'set_epoch'):
+            dataloader.sampler.set_epoch(epoch)
+        num_batch = len(dataloader)
+        meter.reset()
+        meter.start()
+        for i, (x, x_hat, x_cond) in enumerate(profiler.iterate(dataloader)): # 去掉了, celltype
+            with profiler.phase('to_device'):
+                x, x_hat, x_cond = x.float().to(device), x_hat.float().to(device),x_cond.float().to(device)
             # celltype = celltype.to(device)
-            x, x_nonzero_mask, x_zero_mask = mask_tensor_with_masks(x, mask_zero_ratio, mask_nonzero_ratio)
-            x_hat, x_hat_nonzero_mask, x_hat_zero_mask = mask_tensor_with_masks(x_hat, mask_zero_ratio, mask_nonzero_ratio)
-
-            x_noise = torch.randn(x.shape).to(device)
-            x_hat_noise = torch.randn(x_hat.shape).to(device)
+            with profiler.phase('mask'):
+                x, x_nonzero_mask, x_zero_mask = x_masker(x)
+                x_hat, x_hat_nonzero_mask, x_hat_zero_mask = x_hat_masker(x_hat)
 
-            timesteps = torch.randint(1, diffusion_step, (x.shape[0],)).long()
-            timesteps = timesteps.to(device)
-            x_t = noise_scheduler.add_noise(x,
-                                            x_noise,
-                                            timesteps=timesteps)
-
-            x_hat_t = noise_scheduler.add_noise(x_hat,
-                                            x_hat_noise,
-                                            timesteps=timesteps)
+            with profiler.phase('noise'):
+                if timestep_sampler is None:
+                    timesteps = torch.randint(1, diffusion_step, (x.shape[0],)).long()
+                    timesteps = timesteps.to(device)
+                else:
+                    timesteps, weights = timestep_sampler.sample(x.shape[0], device)
+                # 只在被 mask 的非零位置原地加噪, x / x_hat 直接就是 x_noisy / x_hat_noisy
+                x_noise = noise_scheduler.add_noise_(x, x_nonzero_mask, timesteps=timesteps)
+                noise_scheduler.add_noise_(x_hat, x_hat_nonzero_mask, timesteps=timesteps)
 
             # mask = torch.tensor(mask).to(device)
             # mask = (1-((torch.rand(x.shape[1]) < mask_ratio).int())).to(device)
 
-            x_noisy = x_t * x_nonzero_mask + x * (1 - x_nonzero_mask)
-            x_hat_noisy = x_hat_t * x_hat_nonzero_mask + x_hat * (1 - x_hat_nonzero_mask)
+            # 一组累积的 batch 中最后一个才更新参数, 最后一组可能不足 accum_steps 个
+            group_start = i // accum_steps * accum_steps
+            group_size = min(accum_steps, num_batch - group_start)
+            is_update = i + 1 == group_start + group_size
+            # 累积期间不做 DDP 的梯度同步, 只在更新前同步一次
+            sync_context = train_model.no_sync() if is_distributed() and not is_update else contextlib.nullcontext()
+            with sync_context:
+                with profiler.phase('forward'):
+                    noise_pred = train_model(x, x_hat, t=timesteps, y=x_cond) # 去掉了, z=celltype
+                    # loss = criterion(noise_pred, noise)
+
+                    # 被 mask 的零位置没有加噪, 目标噪声单独采样
+                    noise_pred_zero = noise_pred[x_zero_mask]
+                    if timestep_sampler is None:
+                        loss = criterion(noise_pred[x_nonzero_mask], x_noise, noise_pred_zero,
+                                         torch.randn_like(noise_pred_zero), numel=noise_pred.numel())
+                    else:
+                        losses = criterion.per_sample(noise_pred[x_nonzero_mask], x_noise,
+                                                      x_nonzero_mask.nonzero(as_tuple=True)[0],
+                                                      noise_pred_zero, torch.randn_like(noise_pred_zero),
+                                                      x_zero_mask.nonzero(as_tuple=True)[0],
+                                                      batch_size=x.shape[0], row_numel=noise_pred.shape[1])
+                        timestep_sampler.update(timesteps, losses)
+                        loss = (losses * weights).mean()
+                with profiler.phase('backward'):
+                    (loss / group_size).backward()
+            if is_update:
+                with profiler.phase('clip_grad'):
+                    nn.utils.clip_grad_norm_(model.parameters(), 1.0)  # type: ignore
+                with profiler.phase('optimizer'):
+                    optimizer.step()
+                    optimizer.zero_grad()
+                    scheduler.step()
+                    if ema is not None:
+                        ema.update(model)
+            profiler.step()
+            epoch_loss += loss.item()
+            meter.tick(x.shape[0])
+
+        epoch_loss = all_reduce_mean(epoch_loss / (i + 1), device)  # type: ignore
+
+        current_lr = optimizer.param_groups[0]['lr']
+
+        is_stop = False
+        if valid_dataloader is not None and ((epoch + 1) % valid_every == 0 or epoch + 1 == num_epoch):
+            if rank == 0:
+                with profiler.phase('validation'):
+                    valid_loss = valid_diff(eval_model, valid_dataloader, noise_scheduler,
+                                            diffusion_step=diffusion_step,
+                                            device=device,
+                                            mask_nonzero_ratio=valid_mask_nonzero_ratio,
+                                            mask_zero_ratio=valid_mask_zero_ratio)
+            valid_loss = broadcast_object(valid_loss)
+            if valid_loss < best_loss:
+                best_loss, bad_valid = valid_loss, 0
+                best_model = {k: v.detach().clone() for k, v in eval_model.state_dict().items()}
+            else:
+                bad_valid += 1
+                is_stop = patience is not None and bad_valid >= patience
+
+        # 更新tqdm的描述信息
+        if is_tqdm:
+            postfix = f'{pred_type} loss:{epoch_loss:.5f}, lr:{current_lr:.2e}'
+            if valid_loss is not None:
+                postfix += f', valid:{valid_loss:.5f}'
+            t_epoch.set_postfix_str(postfix)  # type: ignore
+
+        if is_tune and rank == 0:
+            # ray 只在 tune.py 的 trial 里才用到
+            from ray.air import session
+            report = {'loss': epoch_loss}
+            if valid_loss is not None:
+                report['valid_loss'] = valid_loss
+            session.report(report)
+
+        if metrics_sink is not None and rank == 0:
+            metrics = {'loss': epoch_loss, 'lr': current_lr}
+            if valid_loss is not None:
+                metrics['valid_loss'] = valid_loss
+            metrics.update(meter.summary())
+            metrics.update(resource_metrics(device))
+            metrics_sink.log('train', metrics, step=epoch + 1)
+
+        if checkpoint_manager is not None and ((epoch + 1) % save_every == 0 or epoch + 1 == num_epoch or is_stop):
+            rng = get_rng_state()
+            generator_state = generator.get_state() if generator is not None else None
+            if is_distributed():
+                rng, generator_state = zip(*all_gather_object((rng, generator_state)))
+                rng, generator_state = list(rng), list(generator_state)
+            if rank == 0:
+                # 提前停止时记为已训练完 num_epoch, resume 时不会再继续训练
+                checkpoint_manager.save({'epoch': num_epoch if is_stop else epoch + 1,
+                                         'model': model.state_dict(),
+                                         'optimizer': optimizer.state_dict(),
+                                         'scheduler': scheduler.state_dict(),
+                                         'rng': rng,
+                                         'generator': generator_state,
+                                         'best_loss': best_loss,
+                                         'best_model': best_model,
+                                         'bad_valid': bad_valid,
+                                         'ema': ema.state_dict() if ema is not None else None,
+                                         'timestep_sampler': timestep_sampler.state_dict()
+                                         if timestep_sampler is not None else None},
+                                        epoch + 1)
+
+        if is_stop:
+            break
 
-            noise_pred = model(x_noisy, x_hat_noisy, t=timesteps.to(device), y=x_cond) # 去掉了, z=celltype
-            # loss = criterion(noise_pred, noise)
+    if checkpoint_manager is not None:
+        checkpoint_manager.wait()
 
-            loss = criterion(x_noise * x_nonzero_mask, noise_pred * x_nonzero_mask, x_noise * x_zero_mask,
-                             noise_pred *  x_zero_mask)
+    if best_model is not None:
+        model.load_state_dict(best_model)
+    elif ema is not None:
+        model.load_state_dict(ema.module.state_dict())
+
+
+def distill_train_diff(teacher,
+                       dataloader,
+                       save_dir,
+                       prefix,
+                       lr: float = 1e-4,
+                       num_epoch: int = 1400,
+                       pred_type: str = 'noise',
+                       diffusion_step: int = 1000,
+                       target_step: int = 4,
+                       device=torch.device('cuda:0'),
+                       is_tqdm: bool = True,
+                       mask_nonzero_ratio=None,
+                       mask_zero_ratio=None):
+    """渐进蒸馏 (progressive distillation)，每一轮用 student 的一步去拟合 teacher 的 factor 步 DDIM，
+    步数依次除以 factor: 先尽量每轮减半, 剩下的倍数按质因数分轮, 如 1000 -> 500 -> 100 -> 20 -> 4.
+    target_step 必须整除 diffusion_step; 倍数中有较大的质因数时, 那一轮 teacher 每个样本要走 factor 步, 较慢
+
+    Args:
+        teacher (DiT_diff): 按 diffusion_step 训练好的模型, 不会被修改.
+        save_dir (str): 每一轮的 checkpoint 和 scheduler 配置的保存目录.
+        prefix (str): 文件名前缀, 第 n 步的文件为 {prefix}_{n}step.pt / .yaml.
+        pred_type (str, optional): teacher 输出的解释方式, student 也按此类型预测. Defaults to 'noise'.
+        diffusion_step (int, optional): teacher 的扩散步数. Defaults to 1000.
+        target_step (int, optional): 蒸馏结束时的步数, 必须整除 diffusion_step. Defaults to 4.
+
+    Returns:
+        (DiT_diff, NoiseScheduler): 最后一轮的 student 以及与之配套的 scheduler, 采样时用 ddim_step.
+    """
+    if target_step < 1 or diffusion_step % target_step:
+        raise ValueError(f'target_step ({target_step}) must divide diffusion_step ({diffusion_step})')
+
+    teacher_scheduler = NoiseScheduler(num_timesteps=diffusion_step,
+                                       beta_schedule='cosine',
+                                       device=device)
+    teacher.to(device)
+
+    while teacher_scheduler.num_timesteps > target_step:
+        factor = _smallest_factor(teacher_scheduler.num_timesteps // target_step)
+        student_step = teacher_scheduler.num_timesteps // factor
+        student_scheduler = NoiseScheduler(num_timesteps=student_step,
+                                           beta_schedule='cosine',
+                                           timestep_stride=teacher_scheduler.timestep_stride * factor,
+                                           device=device)
+        student = copy.deepcopy(teacher)
+        ckpt_path = os.path.join(save_dir, f'{prefix}_{student_step}step.pt')
+
+        if os.path.isfile(ckpt_path):
+            student.load_state_dict(torch.load(ckpt_path))
+        else:
+            _distill_stage(teacher, student, teacher_scheduler, student_scheduler, dataloader,
+                           lr=lr, num_epoch=num_epoch, pred_type=pred_type, device=device,
+                           is_tqdm=is_tqdm, mask_nonzero_ratio=mask_nonzero_ratio,
+                           mask_zero_ratio=mask_zero_ratio)
+            torch.save(student.state_dict(), ckpt_path)
+            with open(os.path.join(save_dir, f'{prefix}_{student_step}step.yaml'), 'w') as yaml_file:
+                yaml.dump(student_scheduler.config(), yaml_file)
+
+        teacher, teacher_scheduler = student, student_scheduler
+
+    return teacher, teacher_scheduler
+
+
+def _smallest_factor(n):
+    # n 的最小质因数, 每轮蒸馏的倍数
+    factor = 2
+    while n % factor:
+        factor += 1
+    return factor
+
+
+def _distill_stage(teacher,
+                   student,
+                   teacher_scheduler,
+                   student_scheduler,
+                   dataloader,
+                   lr,
+                   num_epoch,
+                   pred_type,
+                   device,
+                   is_tqdm,
+                   mask_nonzero_ratio,
+                   mask_zero_ratio):
+    teacher.eval()
+    optimizer = torch.optim.AdamW(student.parameters(), lr=lr, weight_decay=0)
+    scheduler = StepLR(optimizer, step_size=100, gamma=0.1)
+
+    if is_tqdm:
+        t_epoch = tqdm(range(num_epoch), ncols=100)
+    else:
+        t_epoch = range(num_epoch)
+
+    masker = MaskGenerator(mask_nonzero_ratio, mask_zero_ratio)
+    factor = teacher_scheduler.num_timesteps // student_scheduler.num_timesteps
+
+    student.train()
+    for epoch in t_epoch:
+        epoch_loss = 0.
+        for i, (x, x_hat, x_cond) in enumerate(dataloader):
+            x, x_hat, x_cond = x.float().to(device), x_hat.float().to(device), x_cond.float().to(device)
+            x, mask, _ = masker(x)
+
+            # student 的第 k 步对应 teacher 的第 factor*k+factor-1 步, teacher 走 factor 步到 factor*k-1
+            k = torch.randint(0, student_scheduler.num_timesteps, (x.shape[0],), device=device)
+            t_teacher = factor * k + factor - 1
+
+            x_t = teacher_scheduler.add_noise(x, torch.randn_like(x), timesteps=t_teacher)
+            x_noisy = torch.where(mask, x_t, x)
+
+            with torch.no_grad():
+                z_prev = x_noisy
+                for j in range(factor):
+                    if j:
+                        z_prev = torch.where(mask, z_prev, x)
+                    out = teacher(z_prev, x_hat, t=teacher_scheduler.model_timestep(t_teacher - j), y=x_cond)
+                    z_prev, _ = teacher_scheduler.ddim_step(out, t_teacher - j, z_prev, model_pred_type=pred_type)
+
+                # 反解出能让 student 一步 DDIM 到达 z_prev 的 x_0
+                alpha_t = student_scheduler.sqrt_alphas_cumprod[k].reshape(-1, 1)
+                sigma_t = student_scheduler.sqrt_one_minus_alphas_cumprod[k].reshape(-1, 1)
+                alpha_s = student_scheduler.alphas_cumprod_prev[k].reshape(-1, 1) ** 0.5
+                sigma_s = (1. - student_scheduler.alphas_cumprod_prev[k].reshape(-1, 1)) ** 0.5
+                ratio = sigma_s / sigma_t
+                target = (z_prev - ratio * x_noisy) / (alpha_s - ratio * alpha_t)
+                if pred_type == 'noise':
+                    target = (x_noisy - alpha_t * target) / sigma_t
+
+            pred = student(x_noisy, x_hat, t=student_scheduler.model_timestep(k), y=x_cond)
+            loss = F.mse_loss(pred[mask], target[mask])
             loss.backward()
-            nn.utils.clip_grad_norm_(model.parameters(), 1.0)  # type: ignore
+            nn.utils.clip_grad_norm_(student.parameters(), 1.0)  # type: ignore
             optimizer.step()
             optimizer.zero_grad()
             epoch_loss += loss.item()
@@ -138,11 +532,7 @@ def normal_train_diff(model,
         scheduler.step()
         epoch_loss = epoch_loss / (i + 1)  # type: ignore
 
-        current_lr = optimizer.param_groups[0]['lr']
-
-        # 更新tqdm的描述信息
         if is_tqdm:
-            t_epoch.set_postfix_str(f'{pred_type} loss:{epoch_loss:.5f}, lr:{current_lr:.2e}')  # type: ignore
-
-        if is_tune:
-            session.report({'loss': epoch_loss})
+            current_lr = optimizer.param_groups[0]['lr']
+            t_epoch.set_postfix_str(f'{student_scheduler.num_timesteps} step distill loss:{epoch_loss:.5f}, '
+                                    f'lr:{current_lr:.2e}')  # type: ignore
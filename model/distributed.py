@@ -0,0 +1,60 @@
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(device):
+    """用 torchrun 启动时初始化进程组
+
+    cuda 设备使用 nccl, 每个进程绑定 LOCAL_RANK 对应的卡; cpu 使用 gloo.
+    不是 torchrun 启动 (WORLD_SIZE 不存在或为 1) 时什么也不做.
+
+    Returns:
+        tuple: (rank, world_size, device)
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1, device
+    local_rank = int(os.environ['LOCAL_RANK'])
+    if str(device).startswith('cuda'):
+        device = f'cuda:{local_rank}'
+        torch.cuda.set_device(device)
+        backend = 'nccl'
+    else:
+        backend = 'gloo'
+    dist.init_process_group(backend)
+    return dist.get_rank(), world_size, device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def all_reduce_mean(value, device):
+    # 各进程的标量取平均, 用于汇报 loss
+    if not is_distributed():
+        return value
+    tensor = torch.tensor(value, dtype=torch.float64, device=device)
+    dist.all_reduce(tensor)
+    return tensor.item() / dist.get_world_size()
+
+
+def broadcast_object(obj, src=0):
+    # 由 src 进程做决定 (验证 loss / 是否提前停止), 其余进程使用同一个结果
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def all_gather_object(obj):
+    if not is_distributed():
+        return [obj]
+    objects = [None] * dist.get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
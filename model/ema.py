@@ -0,0 +1,43 @@
+import copy
+import torch
+
+
+class EMA:
+    """模型参数的指数滑动平均
+
+    shadow 模型是训练模型的一份拷贝, 每 every 个 step 用 torch._foreach_* 一次性更新所有参数,
+    间隔更新时衰减取 decay ** every, 与每步更新的平均窗口保持一致.
+
+    Args:
+        model (nn.Module): 训练中的模型.
+        decay (float, optional): 每个 step 的衰减系数. Defaults to 0.999.
+        every (int, optional): 更新间隔的 step 数. Defaults to 1.
+    """
+
+    def __init__(self, model, decay=0.999, every=1):
+        self.decay = decay
+        self.every = every
+        self.num_updates = 0
+        self.module = copy.deepcopy(model).eval()
+        self.module.requires_grad_(False)
+        self.shadow = list(self.module.parameters())
+
+    @torch.no_grad()
+    def update(self, model):
+        self.num_updates += 1
+        if self.num_updates % self.every != 0:
+            return
+        decay = self.decay ** self.every
+        params = [p.detach() for p in model.parameters()]
+        torch._foreach_mul_(self.shadow, decay)
+        torch._foreach_add_(self.shadow, params, alpha=1 - decay)
+        # buffer 不参与平均, 直接同步
+        for b_ema, b in zip(self.module.buffers(), model.buffers()):
+            b_ema.copy_(b)
+
+    def state_dict(self):
+        return {'module': self.module.state_dict(), 'num_updates': self.num_updates}
+
+    def load_state_dict(self, state):
+        self.module.load_state_dict(state['module'])
+        self.num_updates = state['num_updates']
@@ -0,0 +1,103 @@
+import os
+import time
+import contextlib
+from collections import defaultdict
+import torch
+
+
+class PhaseTimer:
+    """按阶段 (取数据 / mask / 加噪 / forward / backward ...) 累计耗时
+
+    enabled=False 时所有方法都不做任何事, 训练和采样的代码里可以无条件调用.
+    在 cuda 上计时前后都会同步, 统计的是各阶段真实的耗时, 开启后整体会稍慢一些.
+    trace_dir 不为 None 时用 torch.profiler 记录第 trace_wait + trace_warmup 个 step 之后的 trace_active 个 step,
+    导出成 chrome trace (chrome://tracing 或 perfetto 打开).
+
+    Args:
+        name (str): 汇总表和 trace 文件名的前缀, 例如 'train' / 'sample'.
+        enabled (bool, optional): 是否计时. Defaults to False.
+        device (optional): 计时时需要同步的设备. Defaults to None.
+        trace_dir (str, optional): chrome trace 的保存目录. Defaults to None.
+    """
+
+    def __init__(self, name, enabled=False, device=None, trace_dir=None, trace_wait=1, trace_warmup=1,
+                 trace_active=3):
+        self.name = name
+        self.enabled = enabled
+        self.is_cuda = enabled and str(device).startswith('cuda') and torch.cuda.is_available()
+        self.device = device
+        self.trace_dir = trace_dir if enabled else None
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.profiler = None
+        if self.trace_dir is not None:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.is_cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=trace_wait, warmup=trace_warmup, active=trace_active, repeat=1),
+                on_trace_ready=self._export_trace,
+                record_shapes=True)
+            self.profiler.start()
+
+    def _export_trace(self, prof):
+        path = os.path.join(self.trace_dir, f'{self.name}_trace_{prof.step_num}.json')
+        prof.export_chrome_trace(path)
+        print(f'chrome trace saved to {path}')
+
+    def _sync(self):
+        if self.is_cuda:
+            torch.cuda.synchronize(self.device)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._sync()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+        self._sync()
+        self.times[name] += time.perf_counter() - start
+        self.counts[name] += 1
+
+    def iterate(self, iterable, name='data'):
+        # 把每次从 dataloader 取 batch 的时间记到 name 阶段
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def step(self):
+        if self.profiler is not None:
+            self.profiler.step()
+
+    def summary(self):
+        total = sum(self.times.values())
+        lines = [f'[{self.name}] {"phase":<12}{"total(s)":>10}{"calls":>8}{"mean(ms)":>10}{"share":>8}']
+        for name, seconds in sorted(self.times.items(), key=lambda item: -item[1]):
+            lines.append(f'[{self.name}] {name:<12}{seconds:>10.3f}{self.counts[name]:>8d}'
+                         f'{seconds / self.counts[name] * 1e3:>10.3f}{seconds / max(total, 1e-12):>8.1%}')
+        return '\n'.join(lines)
+
+    def close(self):
+        """停止 profiler, 打印汇总表, 设置了 trace_dir 时同时写到 {name}_summary.txt"""
+        if not self.enabled:
+            return
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+        summary = self.summary()
+        print(summary)
+        if self.trace_dir is not None:
+            with open(os.path.join(self.trace_dir, f'{self.name}_summary.txt'), 'w') as f:
+                f.write(summary + '\n')
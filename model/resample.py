@@ -0,0 +1,74 @@
+import numpy as np
+import torch
+
+from .distributed import is_distributed, all_gather_object
+
+
+class LossSecondMomentSampler:
+    """按每个 timestep 最近 loss 的二阶矩做重要性采样 (improved-DDPM)
+
+    每个 timestep 保存最近 history_per_term 个 loss, 采样概率正比于 sqrt(E[loss^2]),
+    再混入 uniform_prob 的均匀分布. 所有 timestep 的历史都攒满之前使用均匀采样.
+    sample 返回的 weights = 1 / (T * p_t), 对 loss 加权后期望与均匀采样相同.
+
+    Args:
+        num_timesteps (int): 扩散步数, 采样范围为 [min_timestep, num_timesteps).
+        history_per_term (int, optional): 每个 timestep 保存的 loss 个数. Defaults to 10.
+        uniform_prob (float, optional): 混入的均匀分布比例. Defaults to 0.001.
+        min_timestep (int, optional): 最小的 timestep, 与原来的 randint(1, T) 一致. Defaults to 1.
+    """
+
+    def __init__(self, num_timesteps, history_per_term=10, uniform_prob=0.001, min_timestep=1):
+        self.min_timestep = min_timestep
+        self.num_terms = num_timesteps - min_timestep
+        self.history_per_term = history_per_term
+        self.uniform_prob = uniform_prob
+        self.loss_history = np.zeros([self.num_terms, history_per_term], dtype=np.float64)
+        self.loss_counts = np.zeros([self.num_terms], dtype=np.int64)
+
+    def warmed_up(self):
+        return bool((self.loss_counts == self.history_per_term).all())
+
+    def weights(self):
+        if not self.warmed_up():
+            return np.ones([self.num_terms], dtype=np.float64)
+        weights = np.sqrt(np.mean(self.loss_history ** 2, axis=-1))
+        weights /= np.sum(weights)
+        weights *= 1 - self.uniform_prob
+        weights += self.uniform_prob / len(weights)
+        return weights
+
+    def sample(self, batch_size, device):
+        """返回 (timesteps, weights), 都在 device 上"""
+        if not self.warmed_up():
+            # 与均匀采样时的随机数用法相同
+            timesteps = torch.randint(self.min_timestep, self.min_timestep + self.num_terms, (batch_size,)).long()
+            return timesteps.to(device), torch.ones(batch_size, device=device)
+        p = torch.from_numpy(self.weights())
+        indices = torch.multinomial(p, batch_size, replacement=True)
+        weights = 1 / (len(p) * p[indices])
+        return (indices + self.min_timestep).to(device), weights.float().to(device)
+
+    def update(self, timesteps, losses):
+        """用这个 batch 中每个样本的 loss 更新历史, 多进程训练时先汇总所有进程的 loss"""
+        timesteps, losses = timesteps.tolist(), losses.detach().tolist()
+        if is_distributed():
+            gathered = all_gather_object((timesteps, losses))
+            timesteps = [t for ts, _ in gathered for t in ts]
+            losses = [loss for _, ls in gathered for loss in ls]
+        for t, loss in zip(timesteps, losses):
+            t -= self.min_timestep
+            if self.loss_counts[t] == self.history_per_term:
+                # 丢掉最旧的一个
+                self.loss_history[t, :-1] = self.loss_history[t, 1:]
+                self.loss_history[t, -1] = loss
+            else:
+                self.loss_history[t, self.loss_counts[t]] = loss
+                self.loss_counts[t] += 1
+
+    def state_dict(self):
+        return {'loss_history': self.loss_history.copy(), 'loss_counts': self.loss_counts.copy()}
+
+    def load_state_dict(self, state):
+        self.loss_history = state['loss_history'].copy()
+        self.loss_counts = state['loss_counts'].copy()
@@ -3,20 +3,39 @@ from tqdm import tqdm
 import numpy as np
 from collections import defaultdict
 from preprocess.utils import calculate_rmse_per_gene, calculate_pcc_per_gene,calculate_pcc_with_mask,calculate_rmse_with_mask
-from preprocess.utils import mask_tensor_with_masks
-def model_sample_diff(model, device, dataloader, total_sample, time, is_condi, condi_flag):
+from preprocess.utils import mask_tensor_with_masks, seed_everything
+from preprocess.data import ConditionTensorDataset
+from torch.utils.data import DataLoader, Subset
+from .profiler import PhaseTimer
+from .telemetry import StepMeter, resource_metrics
+def model_sample_diff(model, device, dataloader, total_sample, time, is_condi, condi_flag, active=None):
     noise = []
     i = 0
     for _, x_hat, x_cond in dataloader: # 计算整个shape得噪声 一次循环算batch大小  加上了celltype 去掉了, celltype
+        batch_size = len(x_cond)
+        x_sample = total_sample[i:i+batch_size]
+        if active is not None:
+            # 已经收敛的基因不再进入模型, 对应位置的输出置 0
+            batch_active = active[i:i+batch_size]
+            n = torch.zeros_like(x_sample)
+            noise.append(n)
+            i = i+batch_size
+            if not batch_active.any():
+                continue
+            x_sample = x_sample[batch_active]
+            x_hat, x_cond = x_hat[batch_active.cpu()], x_cond[batch_active.cpu()]
         x_hat, x_cond = x_hat.float().to(device), x_cond.float().to(device) # x.float().to(device)
         t = torch.from_numpy(np.repeat(time, x_cond.shape[0])).long().to(device)
         # celltype = celltype.to(device)
         if not is_condi:
-            n = model(total_sample[i:i+len(x_cond)], t, None) # 一次计算batch大小得噪声
+            out = model(x_sample, t, None) # 一次计算batch大小得噪声
         else:
-            n = model(total_sample[i:i+len(x_cond)], x_hat, t, x_cond, condi_flag=condi_flag) # 加上了celltype 去掉了, celltype
-        noise.append(n)
-        i = i+len(x_cond)
+            out = model(x_sample, x_hat, t, x_cond, condi_flag=condi_flag) # 加上了celltype 去掉了, celltype
+        if active is not None:
+            n[batch_active] = out
+        else:
+            noise.append(out)
+            i = i+batch_size
     noise = torch.cat(noise, dim=0)
     return noise
 
@@ -35,13 +54,32 @@ def sample_diff(model,
                 model_pred_type: str = 'noise',
                 is_classifier_guidance=False,
                 omega=0.1,
-                is_tqdm = True):
+                is_ddim=False,
+                tol=None,
+                min_step=0,
+                is_tqdm = True,
+                metric_every=1,
+                profiler=None,
+                metrics_sink=None):
+    """is_classifier_guidance / omega 目前不起作用: 主干 (model.unet) 不使用 condition,
+    有条件和无条件的输出相同, (1 + omega) * x_condi - omega * x_uncondi 就等于有条件的输出, 所以只做一次前向
+
+    tol 不为 None 时启用提前终止: 某个基因 (行) 预测的 x_0 在相邻两步间的相对变化小于 tol,
+    且已经走了至少 min_step 步, 则该基因直接输出当前的 x_0 并退出后续的计算
+
+    is_tqdm 时每 metric_every 步 (以及最后一步) 在进度条上显示当前结果与 gt 的 PCC / RMSE
+
+    profiler 为 PhaseTimer 时记录每一步 forward / step / 提前终止 / 指标计算的耗时
+
+    metrics_sink 不为 None 时在结束后输出 genes/sec, 每秒前向的样本数 (基因 x 步), 每步延迟的分位数和峰值内存"""
+    if profiler is None:
+        profiler = PhaseTimer('sample')
     model.eval()
     gt = torch.tensor(gt).to(device)
     sc = torch.tensor(sc).to(device)
     x_t = torch.randn(sample_shape[0], sample_shape[1]).to(device)
     timesteps = list(range(num_step))[::-1]  # 倒序
-    gt_mask, mask_nonzero, mask_zero = mask_tensor_with_masks(gt, mask_zero_ratio, mask_nonzero_ratio)
+    gt_mask, mask_nonzero, mask_zero = mask_tensor_with_masks(gt, mask_zero_ratio, mask_nonzero_ratio, device=device)
     mask = torch.tensor(mask_nonzero).to(device)
     # mask = None
     # x_t =  x_t * (1 - mask) + gt * mask
@@ -49,48 +87,142 @@ def sample_diff(model,
     x_t = x_t
     if sample_intermediate:
         timesteps = timesteps[:sample_intermediate]
+    active = torch.ones(sample_shape[0], dtype=torch.bool, device=device) if tol is not None else None
+    prev_x0 = None
 
-    ts = tqdm(timesteps)
+    ts = tqdm(timesteps) if is_tqdm else timesteps
+    meter = StepMeter(device, enabled=metrics_sink is not None)
+    meter.start()
     for t_idx, time in enumerate(ts):
-        ts.set_description_str(desc=f'time: {time}')
-        with torch.no_grad():
+        if is_tqdm:
+            ts.set_description_str(desc=f'time: {time}')
+        # 这一步进入模型的基因数
+        num_evaluated = sample_shape[0] if active is None else int(active.sum())
+        with torch.no_grad(), profiler.phase('forward'):
             # 输出噪声
             model_output = model_sample_diff(model,
                                         device=device,
                                         dataloader=dataloader,
                                         total_sample=x_t,  # x_t
-                                        time=time,  # t
+                                        time=noise_scheduler.model_timestep(time),  # t
                                         is_condi=is_condi,
-                                        condi_flag=True)
-            if is_classifier_guidance:
-                model_output_uncondi = model_sample_diff(model,
-                                                    device=device,
-                                                    dataloader=dataloader,
-                                                    total_sample=x_t,
-                                                    time=time,
-                                                    is_condi=is_condi,
-                                                    condi_flag=False)
-                model_output = (1 + omega) * model_output - omega * model_output_uncondi
-
-        # 计算x_{t-1}
-        x_t, _ = noise_scheduler.step(model_output,  # 一般是噪声
-                                     torch.from_numpy(np.array(time)).long().to(device),
-                                      x_t,
-                                         model_pred_type=model_pred_type)
+                                        condi_flag=True,
+                                        active=active)
+
+        # 计算x_{t-1}, 蒸馏得到的 student 用确定性的 DDIM 采样
+        with profiler.phase('step'):
+            step = noise_scheduler.ddim_step if is_ddim else noise_scheduler.step
+            x_prev, x0 = step(model_output,  # 一般是噪声
+                                         torch.from_numpy(np.array(time)).long().to(device),
+                                          x_t,
+                                             model_pred_type=model_pred_type)
+        if active is None:
+            x_t = x_prev
+        else:
+            with profiler.phase('early_stop'):
+                x_t = torch.where(active[:, None], x_prev, x_t)
+                if prev_x0 is not None and t_idx + 1 >= min_step:
+                    delta = (x0 - prev_x0).norm(dim=1) / prev_x0.norm(dim=1).clamp_min(1e-8)
+                    converged = active & (delta < tol)
+                    # 收敛的基因用预测的 x_0 作为最终结果
+                    x_t = torch.where(converged[:, None], x0, x_t)
+                    active = active & ~converged
+                prev_x0 = x0
         # epoch_pcc = calculate_pcc_with_mask(x_t, gt_mask, mask_nonzero)
         # epoch_rmse = calculate_rmse_with_mask(x_t, gt_mask, mask_nonzero)
-        epoch_pcc = calculate_pcc_per_gene(x_t, gt)
-        epoch_rmse = calculate_rmse_per_gene(x_t, gt)
-        ts.set_postfix_str(f'PCC:{epoch_pcc:.5f}, RMSE:'
-                           f'{epoch_rmse:.5f}')
+        is_last = t_idx + 1 == len(timesteps) or (active is not None and not active.any())
+        if is_tqdm and ((t_idx + 1) % metric_every == 0 or is_last):
+            with profiler.phase('metric'):
+                epoch_pcc = calculate_pcc_per_gene(x_t, gt)
+                epoch_rmse = calculate_rmse_per_gene(x_t, gt)
+            ts.set_postfix_str(f'PCC:{epoch_pcc:.5f}, RMSE:'
+                               f'{epoch_rmse:.5f}')
         if mask is not None:
-            x_t = x_t *  mask + (1 - mask) * gt
+            with profiler.phase('mask'):
+                x_t = x_t *  mask + (1 - mask) * gt
+        profiler.step()
+        meter.tick(num_evaluated)
 
         if time == 0 and model_pred_type == 'x_start':
             # 如果直接预测 x_0 的话，最后一步直接输出
             sample = model_output
 
+        if active is not None and not active.any():
+            break
+
+
+    if metrics_sink is not None:
+        metrics = meter.summary()
+        metrics['genes_per_sec'] = sample_shape[0] / sum(meter.latencies)
+        metrics.update(resource_metrics(device))
+        metrics_sink.log('sample', metrics)
 
     recon_x = x_t.detach().cpu().numpy()
     return recon_x
 
+
+def shard_seed(seed, shard_id):
+    # 每个 shard 的随机种子只由全局种子和 shard 编号决定, 与 worker 数无关
+    return int(np.random.SeedSequence([seed, shard_id]).generate_state(1)[0])
+
+
+def _sample_shards(rank, workers, model, dataset, shards, prediction, noise_scheduler, num_threads, seed,
+                   batch_size, device, sample_kwargs):
+    torch.set_num_threads(num_threads)
+    model = model.to(device)
+    offset = 0
+    for shard_id, indices in enumerate(shards):
+        if shard_id % workers == rank:
+            seed_everything(shard_seed(seed, shard_id))
+            dataloader = DataLoader(Subset(dataset, indices), batch_size=batch_size, shuffle=False)
+            gt = dataset.st_sample[indices]
+            prediction[offset:offset + len(indices)] = torch.from_numpy(
+                sample_diff(model,
+                            dataloader=dataloader,
+                            noise_scheduler=noise_scheduler,
+                            gt=gt,
+                            sc=dataset.sc_sample[indices],
+                            device=device,
+                            sample_shape=(gt.shape[0], gt.shape[1]),
+                            **sample_kwargs))
+        offset += len(indices)
+
+
+def parallel_sample_diff(model,
+                         dataset,
+                         indices,
+                         noise_scheduler,
+                         workers=1,
+                         shard_size=256,
+                         seed=3407,
+                         batch_size=64,
+                         device='cpu',
+                         **sample_kwargs):
+    """把 indices 对应的基因按 shard_size 切成 shard, 由 workers 个进程并行 sample_diff
+
+    模型参数和 condition 通过共享内存传给子进程, 每个进程用 torch.get_num_threads() // workers 个线程.
+    每个 shard 用 shard_seed(seed, shard_id) 作为随机种子, 所以结果与 workers 的数量无关.
+
+    Args:
+        dataset (ConditionalDiffusionDataset): 完整的数据集, indices 为其中的基因下标.
+        sample_kwargs: 直接传给 sample_diff 的参数, 如 num_step, model_pred_type 等.
+
+    Returns:
+        np.ndarray: 按 indices 顺序的预测结果, 形状为 (len(indices), spot_num).
+    """
+    indices = list(indices)
+    shards = [indices[i:i + shard_size] for i in range(0, len(indices), shard_size)]
+    dataset = ConditionTensorDataset(dataset.st_sample.share_memory_(),
+                                     dataset.sc_sample.share_memory_(),
+                                     dataset.sc_data.share_memory_())
+    prediction = torch.empty(len(indices), dataset.st_sample.shape[1]).share_memory_()
+    model.to('cpu').share_memory()
+    num_threads = max(1, torch.get_num_threads() // workers)
+    args = (workers, model, dataset, shards, prediction, noise_scheduler, num_threads, seed, batch_size, device,
+            sample_kwargs)
+
+    if workers == 1:
+        _sample_shards(0, *args)
+    else:
+        torch.multiprocessing.spawn(_sample_shards, args=args, nprocs=workers)
+    return prediction.numpy()
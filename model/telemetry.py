@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import numpy as np
+import torch
+
+
+class MetricsSink:
+    """指标输出的接口, log 的 metrics 是 {名字: 数值}, prefix 区分 train / sample"""
+
+    def log(self, prefix, metrics, step=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JsonlSink(MetricsSink):
+    # 每次 log 追加一行 json
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, 'a')
+
+    def log(self, prefix, metrics, step=None):
+        record = {'time': time.time(), 'prefix': prefix, 'step': step}
+        record.update(metrics)
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class TensorBoardSink(MetricsSink):
+    def __init__(self, log_dir):
+        from torch.utils.tensorboard import SummaryWriter
+        self.writer = SummaryWriter(log_dir)
+        self.steps = {}
+
+    def log(self, prefix, metrics, step=None):
+        if step is None:
+            # 没有给 step 时按每个 prefix 的 log 次数计
+            step = self.steps[prefix] = self.steps.get(prefix, 0) + 1
+        for name, value in metrics.items():
+            self.writer.add_scalar(f'{prefix}/{name}', value, step)
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+class PrometheusSink(MetricsSink):
+    # 在 port 上开一个 http 文本接口, 每个指标是一个 gauge: spadit_{prefix}_{name}
+    def __init__(self, port):
+        import prometheus_client
+        self.prometheus_client = prometheus_client
+        self.gauges = {}
+        prometheus_client.start_http_server(int(port))
+
+    def log(self, prefix, metrics, step=None):
+        for name, value in metrics.items():
+            key = f'spadit_{prefix}_{name}'
+            if key not in self.gauges:
+                self.gauges[key] = self.prometheus_client.Gauge(key, f'{prefix} {name}')
+            self.gauges[key].set(value)
+
+
+class MultiSink(MetricsSink):
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def log(self, prefix, metrics, step=None):
+        for sink in self.sinks:
+            sink.log(prefix, metrics, step)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+SINKS = {'jsonl': JsonlSink, 'tensorboard': TensorBoardSink, 'prometheus': PrometheusSink}
+
+
+def build_sink(specs):
+    """按 'jsonl:<path>' / 'tensorboard:<log_dir>' / 'prometheus:<port>' 创建 sink
+
+    tensorboard 和 prometheus_client 只在用到时才 import.
+
+    Returns:
+        MetricsSink: specs 为空时返回 None
+    """
+    if not specs:
+        return None
+    sinks = []
+    for spec in specs:
+        kind, _, target = spec.partition(':')
+        if kind not in SINKS:
+            raise ValueError(f'unknown metrics sink: {spec}, expected one of {list(SINKS)}')
+        sinks.append(SINKS[kind](target))
+    return sinks[0] if len(sinks) == 1 else MultiSink(sinks)
+
+
+class StepMeter:
+    """记录每一步的耗时和处理的样本数, 汇总成吞吐和延迟分位数
+
+    tick 记录的是距离上一次 tick (或 start) 的时间, 训练时包含了取数据的时间.
+    cuda 上每次 tick 都要同步, 所以 enabled 为 False (没有 metrics sink) 时 tick 什么都不做.
+    """
+
+    def __init__(self, device=None, enabled=True):
+        self.is_cuda = str(device).startswith('cuda') and torch.cuda.is_available()
+        self.device = device
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.latencies = []
+        self.num_samples = 0
+        self.last = None
+
+    def start(self):
+        self.last = time.perf_counter()
+
+    def tick(self, num_samples):
+        if not self.enabled:
+            return
+        if self.is_cuda:
+            torch.cuda.synchronize(self.device)
+        now = time.perf_counter()
+        if self.last is not None:
+            self.latencies.append(now - self.last)
+            self.num_samples += num_samples
+        self.last = now
+
+    def summary(self):
+        if not self.latencies:
+            return {}
+        latencies = np.array(self.latencies) * 1e3
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        return {'samples_per_sec': self.num_samples / (latencies.sum() / 1e3),
+                'step_ms_p50': p50,
+                'step_ms_p90': p90,
+                'step_ms_p99': p99}
+
+
+def resource_metrics(device=None):
+    """进程的峰值 RSS 以及 cuda 上的峰值显存, 单位 MB"""
+    metrics = {}
+    try:
+        import resource
+        # linux 上 ru_maxrss 的单位是 KB
+        metrics['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        import psutil
+        metrics['peak_rss_mb'] = psutil.Process().memory_info().rss / 2 ** 20
+    if str(device).startswith('cuda') and torch.cuda.is_available():
+        metrics['peak_device_mb'] = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return metrics
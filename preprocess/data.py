@@ -1,17 +1,11 @@
 import scipy
-import anndata as ad
-import scanpy as sc
 import numpy as np
 import pandas as pd
 import torch
-import matplotlib.pyplot as plt
 from tqdm import tqdm
 from torch.utils.data import TensorDataset, DataLoader, Dataset
 from scipy.sparse import issparse, csr
-from anndata import AnnData
-from sklearn.preprocessing import maxabs_scale, MaxAbsScaler
-from scipy.spatial.distance import cdist
-from sklearn.neighbors import NearestNeighbors
+# scanpy / sklearn 只在画图和归一化的函数里导入, anndata (会带上 h5py) 只在读数据的时候导入
 CHUNK_SIZE = 20000
 
 # class ConditionalDiffusionDataset(Dataset):
@@ -51,8 +45,9 @@ CHUNK_SIZE = 20000
 
 class ConditionalDiffusionDataset(Dataset):
     def __init__(self, sc_path, st_path):
-        self.sc_data = sc.read_h5ad(sc_path)
-        self.st_data = sc.read_h5ad(st_path)
+        import anndata as ad
+        self.sc_data = ad.read_h5ad(sc_path)
+        self.st_data = ad.read_h5ad(st_path)
         self.st_data = self.st_data.to_df().T
         self.sc_data = self.sc_data.to_df().T
 
@@ -73,6 +68,20 @@ class ConditionalDiffusionDataset(Dataset):
         return self.gene_names
 
 
+class ConditionTensorDataset(Dataset):
+    # 只保留 ConditionalDiffusionDataset 里的张量, 通过共享内存传给子进程时不会复制 DataFrame
+    def __init__(self, st_sample, sc_sample, sc_data):
+        self.st_sample = st_sample
+        self.sc_sample = sc_sample
+        self.sc_data = sc_data
+
+    def __len__(self):
+        return len(self.st_sample)
+
+    def __getitem__(self, idx):
+        return self.st_sample[idx], self.sc_sample[idx], self.sc_data
+
+
 
 def reindex(adata, genes, chunk_size=CHUNK_SIZE):
     """
@@ -99,11 +108,13 @@ def reindex(adata, genes, chunk_size=CHUNK_SIZE):
         new_X = scipy.sparse.lil_matrix((adata.shape[0], len(genes)))
         for i in range(new_X.shape[0] // chunk_size + 1):
             new_X[i * chunk_size:(i + 1) * chunk_size, idx] = adata[i * chunk_size:(i + 1) * chunk_size, genes[idx]].X
+        from anndata import AnnData
         adata = AnnData(new_X.tocsr(), obs=adata.obs, var={'var_names': genes})
     return adata
 
 
 def plot_hvg_umap(hvg_adata, color=['celltype'], save_filename=None):
+    import scanpy as sc
     sc.set_figure_params(dpi=80, figsize=(3, 3))  # type: ignore
     hvg_adata = hvg_adata.copy()
     if save_filename:
@@ -136,6 +147,7 @@ def get_data_loader(data_ary: np.ndarray,
 
 
 def scale(adata):
+    from sklearn.preprocessing import MaxAbsScaler
     scaler = MaxAbsScaler()
     # 对adata.X按行进行归一化
     normalized_data = scaler.fit_transform(adata.X.T).T
@@ -145,7 +157,7 @@ def scale(adata):
     return adata
 
 
-def data_augment(adata: AnnData, fixed: bool, noise_std):
+def data_augment(adata: 'AnnData', fixed: bool, noise_std):
     # 定义增强参数，例如噪声的标准差
     noise_stddev = noise_std
     augmented_adata = adata.copy()
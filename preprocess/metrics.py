@@ -0,0 +1,128 @@
+"""按列计算的评价指标, 每一列 (一个基因) 在 axis=-2 上归约
+
+输入可以是 numpy 数组或 torch 张量, 形状为 (..., n, genes), 返回 (..., genes).
+前面的维度直接广播, 例如 bootstrap 重采样时的 (B, n, genes) 一次就能算完.
+"""
+import numpy as np
+import torch
+
+
+def _is_torch(x):
+    return isinstance(x, torch.Tensor)
+
+
+def _mean(x, keepdims=False):
+    if _is_torch(x):
+        return x.mean(dim=-2, keepdim=keepdims)
+    return x.mean(axis=-2, keepdims=keepdims)
+
+
+def _sum(x, keepdims=False):
+    if _is_torch(x):
+        return x.sum(dim=-2, keepdim=keepdims)
+    return x.sum(axis=-2, keepdims=keepdims)
+
+
+def _mean_prod(x, y):
+    # mean(x * y); numpy 上 einsum 不产生 x * y 的中间矩阵, 快很多, torch 的 einsum 反而更慢
+    if _is_torch(x):
+        return (x * y).mean(dim=-2)
+    return np.einsum('...ij,...ij->...j', x, y) / x.shape[-2]
+
+
+def _max(x):
+    if _is_torch(x):
+        return x.amax(dim=-2)
+    return x.max(axis=-2)
+
+
+def _sqrt(x):
+    return torch.sqrt(x) if _is_torch(x) else np.sqrt(x)
+
+
+def _maximum(x, y):
+    return torch.maximum(x, y) if _is_torch(x) else np.maximum(x, y)
+
+
+def _rel_entr(x, y):
+    # 与 scipy.special.rel_entr 相同: x, y > 0 时为 x * log(x / y), x == 0 且 y >= 0 时为 0, 其余 (有负值) 为 inf
+    positive = (x > 0) & (y > 0)
+    finite = positive | ((x == 0) & (y >= 0))
+    if _is_torch(x):
+        value = torch.where(positive, x * torch.log(torch.where(positive, x / y, torch.ones_like(x))),
+                            torch.zeros_like(x))
+        return torch.where(finite, value, torch.full_like(value, float('inf')))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        value = np.where(positive, x * np.log(np.where(positive, x / y, 1.)), 0.)
+    return np.where(finite, value, np.inf)
+
+
+def column_moments(a, b):
+    """每一列的均值, 总体方差以及两者的协方差
+
+    Returns:
+        tuple: (mu_a, mu_b, var_a, var_b, cov), 形状都是 (..., genes)
+    """
+    mu_a, mu_b = _mean(a, keepdims=True), _mean(b, keepdims=True)
+    da, db = a - mu_a, b - mu_b
+    return mu_a[..., 0, :], mu_b[..., 0, :], _mean_prod(da, da), _mean_prod(db, db), _mean_prod(da, db)
+
+
+def column_pcc(a, b):
+    # 方差为 0 的列与 scipy.stats.pearsonr 一样得到 nan
+    _, _, var_a, var_b, cov = column_moments(a, b)
+    return cov / _sqrt(var_a * var_b)
+
+
+def column_rmse(a, b):
+    diff = a - b
+    return _sqrt(_mean_prod(diff, diff))
+
+
+def column_ssim(a, b, M=None):
+    """与 cal_ssim 相同的 SSIM, 每一列看作 n x 1 的图像
+
+    Args:
+        M (optional): 动态范围 L, 可以是标量或每列一个值. 默认取两列最大值中较大的一个
+            (calculate_metrics/cal_as.py 的约定); CalculateMeteics 使用较小的一个.
+    """
+    mu_a, mu_b, var_a, var_b, cov = column_moments(a, b)
+    if M is None:
+        M = _maximum(_max(a), _max(b))
+    return ssim_from_moments(mu_a, mu_b, var_a, var_b, cov, M)
+
+
+def ssim_from_moments(mu_a, mu_b, var_a, var_b, cov, M):
+    # 由 column_moments 的结果计算 SSIM, 分块统计时不需要完整的矩阵
+    C1 = (0.01 * M) ** 2
+    C2 = (0.03 * M) ** 2
+    C3 = C2 / 2
+    sigma_a, sigma_b = _sqrt(var_a), _sqrt(var_b)
+    l12 = (2 * mu_a * mu_b + C1) / (mu_a ** 2 + mu_b ** 2 + C1)
+    c12 = (2 * sigma_a * sigma_b + C2) / (var_a + var_b + C2)
+    s12 = (cov + C3) / (sigma_a * sigma_b + C3)
+    return l12 * c12 * s12
+
+
+def column_rel_entr(p, q):
+    # 每一列 scipy.special.rel_entr 的和, 不做归一化; 归一化常数已知时可以逐块累加
+    return _sum(_rel_entr(p, q))
+
+
+def column_kl(p, q):
+    # 与 scipy.stats.entropy(p, q) 相同, p 和 q 先各自归一化
+    p = p / _sum(p, keepdims=True)
+    q = q / _sum(q, keepdims=True)
+    return column_rel_entr(p, q)
+
+
+def column_js(p, q, distance=False):
+    """每一列先归一化成概率分布, 再计算 Jensen-Shannon 散度 (自然对数)
+
+    distance=True 时返回其平方根, 即 scipy.spatial.distance.jensenshannon.
+    """
+    p = p / _sum(p, keepdims=True)
+    q = q / _sum(q, keepdims=True)
+    m = (p + q) / 2
+    js = (column_rel_entr(p, m) + column_rel_entr(q, m)) / 2
+    return _sqrt(js) if distance else js
@@ -1,6 +1,13 @@
+import math
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
 import seaborn as sns
 import numpy as np
+import pandas as pd
+import scipy.sparse as sp
 import matplotlib.pyplot as plt
+import anndata as ad
 import scanpy as sc
 
 from sklearn.metrics import adjusted_mutual_info_score, adjusted_rand_score, homogeneity_score, \
@@ -50,7 +57,78 @@ def clustering_metrics(adata, target, pred, mode="AMI"):
         print("NMI ", nmi)
         return nmi
 
-def get_N_clusters(adata, n_cluster, cluster_method='louvain', range_min=0, range_max=3, max_steps=30, tolerance=0):
+# 进程池中每个 worker 通过共享内存读取同一个近邻图, 不复制
+_graph = None
+
+
+def _share_array(array):
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _attach_graph(specs, shape):
+    global _graph
+    handles = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    data, indices, indptr = [np.ndarray(array_shape, dtype=np.dtype(dtype), buffer=handle.buf)
+                             for handle, (_, array_shape, dtype) in zip(handles, specs)]
+    # handles 需要和矩阵一起保留, 否则共享内存会被关闭
+    _graph = (handles, sp.csr_matrix((data, indices, indptr), shape=shape, copy=False))
+
+
+def _cluster_at(resolution, cluster_method):
+    _, adjacency = _graph
+    tmp = ad.AnnData(obs=pd.DataFrame(index=np.arange(adjacency.shape[0]).astype(str)))
+    if cluster_method == 'leiden':
+        sc.tl.leiden(tmp, resolution=resolution, adjacency=adjacency)
+    if cluster_method == 'louvain':
+        sc.tl.louvain(tmp, resolution=resolution, adjacency=adjacency)
+    return tmp.obs[cluster_method].values, tmp.uns[cluster_method]
+
+
+def _parallel_resolution_search(adata, n_cluster, cluster_method, this_min, this_max, max_steps, tolerance, workers,
+                                batch_size):
+    # 每轮在当前区间内等距取 batch_size 个分辨率并行聚类, 区间缩小为原来的 1 / (batch_size + 1);
+    # 轮数按与 max_steps 步二分相同的区间精度计算
+    max_rounds = max(1, math.ceil(max_steps / math.log2(batch_size + 1)))
+    adjacency = adata.obsp['connectivities'].tocsr()
+    shared = [_share_array(array) for array in (adjacency.data, adjacency.indices, adjacency.indptr)]
+    best = None
+    try:
+        # numba 的 TBB 线程池在 fork 之后退出时会卡住, 用 spawn 启动 worker
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_attach_graph,
+                                 initargs=([spec for _, spec in shared], adjacency.shape)) as pool:
+            for _ in range(max_rounds):
+                resolutions = np.linspace(this_min, this_max, batch_size + 2)[1:-1].tolist()
+                results = list(pool.map(_cluster_at, resolutions, [cluster_method] * batch_size))
+                counts = [pd.unique(labels).size for labels, _ in results]
+                for resolution, count, result in zip(resolutions, counts, results):
+                    if best is None or abs(count - n_cluster) < abs(best[1] - n_cluster):
+                        best = (resolution, count, result)
+                if abs(best[1] - n_cluster) <= tolerance:
+                    break
+                # 聚类数大致随分辨率单调增加, 新区间取最后一个偏少和第一个偏多的分辨率之间
+                this_max = min([r for r, c in zip(resolutions, counts) if c > n_cluster + tolerance], default=this_max)
+                this_min = max([r for r, c in zip(resolutions, counts) if c < n_cluster - tolerance and r < this_max],
+                               default=this_min)
+    finally:
+        for shm, _ in shared:
+            shm.close()
+            shm.unlink()
+
+    resolution, count, (labels, params) = best
+    adata.obs[cluster_method] = pd.Categorical(labels)
+    adata.uns[cluster_method] = params
+    if abs(count - n_cluster) <= tolerance:
+        print("Succeed to find %d clusters at resolution %.3f."%(n_cluster, resolution))
+    else:
+        print('Cannot find the number of clusters.')
+    return adata
+
+
+def get_N_clusters(adata, n_cluster, cluster_method='louvain', range_min=0, range_max=3, max_steps=30, tolerance=0,
+                   workers=0, batch_size=None):
     """
     Tune the resolution parameter in clustering to make the number of clusters and the specified number as close as possible.
    
@@ -70,6 +148,12 @@ def get_N_clusters(adata, n_cluster, cluster_method='louvain', range_min=0, rang
         Maximum number of steps for the binary search.
     tolerance
         Tolerance of the difference between the number of clusters and the specified number.
+    workers
+        Number of processes clustering candidate resolutions concurrently. By default, workers=0 runs the sequential
+        binary search; otherwise every round clusters `batch_size` evenly spaced resolutions of the current range
+        on the shared neighbor graph and narrows the range around the target.
+    batch_size
+        Number of candidate resolutions per round when workers > 0. By default, batch_size=workers.
 
     Returns
     -------
@@ -88,6 +172,10 @@ def get_N_clusters(adata, n_cluster, cluster_method='louvain', range_min=0, rang
     sc.tl.pca(adata)
     sc.pp.neighbors(adata, n_pcs=30, n_neighbors=30)
 
+    if workers:
+        return _parallel_resolution_search(adata, n_cluster, cluster_method, this_min, this_max, max_steps, tolerance,
+                                           workers, batch_size or workers)
+
     while this_step < max_steps:
         this_resolution = this_min + ((this_max-this_min)/2)
         if cluster_method=='leiden':
@@ -1,17 +1,15 @@
 import pandas as pd
 import numpy as np
-import scanpy as sc
-import scipy.stats as st
 import os
-import seaborn as sns
+import hashlib
 import scipy
 from scipy.sparse import csr_matrix
 import torch
 import random
-from sklearn.metrics import adjusted_mutual_info_score, adjusted_rand_score, homogeneity_score, \
-    normalized_mutual_info_score
 from torch.utils.data import DataLoader, random_split
-from sklearn.model_selection import train_test_split
+from .metrics import column_pcc, column_rmse, column_ssim, column_kl
+
+# scanpy / scipy.stats / sklearn 导入很慢, 只在用到的函数里导入, 训练和采样的启动不需要加载它们
 
 
 def pca_with_torch(X, k=100):
@@ -52,6 +50,60 @@ def mask_tensor_with_masks(X, mask_zero_ratio, mask_nonzero_ratio, device='cuda:
 
     return masked_X, M_nonzero_mask, M_zero_mask
 
+class MaskGenerator:
+    """训练时的 mask 生成器, 代替 mask_tensor_with_masks
+
+    一次 torch.rand 同时得到非零和零位置的 Bernoulli mask, 不需要 nonzero/randperm,
+    输出写在复用的 buffer 里, 下一次调用时会被覆盖.
+
+    Args:
+        mask_nonzero_ratio (float): 非零位置被 mask 的比例.
+        mask_zero_ratio (float): 零位置被 mask 的比例.
+        exact (bool, optional): 为 True 时每次恰好 mask round(ratio * 个数) 个位置, 与 mask_tensor_with_masks 一致.
+            Defaults to False.
+        generator (torch.Generator, optional): 随机数生成器, 需要和输入在同一个 device 上. Defaults to None.
+    """
+
+    def __init__(self, mask_nonzero_ratio, mask_zero_ratio, exact=False, generator=None):
+        self.mask_nonzero_ratio = mask_nonzero_ratio or 0.
+        self.mask_zero_ratio = mask_zero_ratio or 0.
+        self.exact = exact
+        self.generator = generator
+        self._buffers = {}
+
+    def _buffer(self, name, X, dtype):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != X.shape or buffer.device != X.device:
+            buffer = torch.empty(X.shape, dtype=dtype, device=X.device)
+            self._buffers[name] = buffer
+        return buffer
+
+    def _exact_threshold(self, rand, candidate, ratio):
+        # 在 candidate 位置中取第 k 小的随机数作为阈值, 小于等于它的恰好 k 个
+        k = int(round(ratio * candidate.sum().item()))
+        if k == 0:
+            return -1.
+        return torch.kthvalue(rand.masked_fill(~candidate, 2.).flatten(), k).values
+
+    def __call__(self, X):
+        rand = torch.rand(X.shape, generator=self.generator, device=X.device, out=self._buffer('rand', X, X.dtype))
+        nonzero = torch.ne(X, 0, out=self._buffer('nonzero', X, torch.bool))
+
+        if self.exact:
+            nonzero_threshold = self._exact_threshold(rand, nonzero, self.mask_nonzero_ratio)
+            zero_threshold = self._exact_threshold(rand, ~nonzero, self.mask_zero_ratio)
+            nonzero_mask = torch.le(rand, nonzero_threshold, out=self._buffer('nonzero_mask', X, torch.bool))
+            zero_mask = torch.le(rand, zero_threshold, out=self._buffer('zero_mask', X, torch.bool))
+        else:
+            nonzero_mask = torch.lt(rand, self.mask_nonzero_ratio, out=self._buffer('nonzero_mask', X, torch.bool))
+            zero_mask = torch.lt(rand, self.mask_zero_ratio, out=self._buffer('zero_mask', X, torch.bool))
+        nonzero_mask.logical_and_(nonzero)
+        zero_mask.masked_fill_(nonzero, False)
+
+        # 零位置本来就是 0, 只需要把被 mask 的非零位置置 0
+        masked_X = self._buffer('masked_X', X, X.dtype).copy_(X).masked_fill_(nonzero_mask, 0)
+        return masked_X, nonzero_mask, zero_mask
+
 def clustering_metrics(adata, target, pred, mode="AMI"):
     """
     Evaluate clustering performance.
@@ -77,6 +129,8 @@ def clustering_metrics(adata, target, pred, mode="AMI"):
         Normalized mutual information score.
 
     """
+    from sklearn.metrics import adjusted_mutual_info_score, adjusted_rand_score, homogeneity_score, \
+        normalized_mutual_info_score
     if(mode=="AMI"):
         ami = adjusted_mutual_info_score(adata.obs[target], adata.obs[pred])
         print("AMI ",ami)
@@ -94,6 +148,50 @@ def clustering_metrics(adata, target, pred, mode="AMI"):
         print("NMI ", nmi)
         return nmi
 
+# 参考聚类的内存缓存, key 为数据内容和聚类参数的 hash
+_reference_cache = {}
+
+
+def _matrix_hash(X, *extra):
+    h = hashlib.sha1(repr((X.shape, str(X.dtype)) + extra).encode())
+    if scipy.sparse.issparse(X):
+        X = X.tocsr()
+        parts = (X.data, X.indices, X.indptr)
+    else:
+        parts = (np.asarray(X),)
+    for part in parts:
+        h.update(np.ascontiguousarray(part))
+    return h.hexdigest()
+
+
+def reference_clustering(adata, cache_dir=None, n_pcs=30, n_neighbors=30):
+    """ground truth 的 PCA, 近邻图和 leiden 标签, 同一份数据只计算一次
+
+    结果按 adata.X 的内容 hash 缓存在内存中, cache_dir 不为 None 时同时保存为
+    {cache_dir}/reference_cluster_{hash}.h5ad, 之后的运行直接读取. 传入的 adata 不会被修改.
+
+    Returns:
+        AnnData: 带有 obsm['X_pca'], 近邻图和 obs['leiden'] 的副本, 被多次调用共享, 不要修改
+    """
+    key = _matrix_hash(adata.X, n_pcs, n_neighbors)
+    if key in _reference_cache:
+        return _reference_cache[key]
+    import scanpy as sc
+    path = None if cache_dir is None else os.path.join(cache_dir, f'reference_cluster_{key}.h5ad')
+    if path is not None and os.path.exists(path):
+        reference = sc.read_h5ad(path)
+    else:
+        reference = adata.copy()
+        sc.tl.pca(reference)
+        sc.pp.neighbors(reference, n_pcs=n_pcs, n_neighbors=n_neighbors)
+        sc.tl.leiden(reference)
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            reference.write_h5ad(path)
+    _reference_cache[key] = reference
+    return reference
+
+
 def calculate_pcc(tensor1, tensor2):
     assert tensor1.shape == tensor2.shape, "Input tensors must have the same shape."
     mean1 = tensor1.mean(dim=0)
@@ -148,37 +246,17 @@ def calculate_rmse_with_mask(tensor1, tensor2, mask):
 
 
 def calculate_pcc_per_gene(true_labels, predicted_labels):
-    pcc_sum = 0.0
-    for gene in range(true_labels.shape[1]):
-        y_true = true_labels[:, gene]
-        y_pred = predicted_labels[:, gene]
-
-        mean_true = y_true.mean()
-        mean_pred = y_pred.mean()
-
-        covariance = ((y_true - mean_true) * (y_pred - mean_pred)).mean()
-        variance_true = ((y_true - mean_true) ** 2).mean()
-        variance_pred = ((y_pred - mean_pred) ** 2).mean()
-
-        pcc = covariance / torch.sqrt(variance_true * variance_pred)
-        pcc_sum += pcc
-
-    return (pcc_sum / true_labels.shape[1]).item()
+    # 每一列的 PCC 取平均, 所有列一次归约完成
+    return column_pcc(true_labels, predicted_labels).mean().item()
 
 
 def calculate_rmse_per_gene(true_labels, predicted_labels):
-    mse_sum = 0.0
-    for gene in range(true_labels.shape[1]):
-        y_true = true_labels[:, gene]
-        y_pred = predicted_labels[:, gene]
-
-        mse = torch.mean((y_true - y_pred) ** 2)
-        mse_sum += mse
-
-    return torch.sqrt(mse_sum / true_labels.shape[1]).item()
+    # 每列长度相同, 各列 MSE 的平均就是整个矩阵的 MSE
+    return torch.sqrt(((true_labels - predicted_labels) ** 2).mean()).item()
 
 def split_dataset_with_gene_names(dataset, train_ratio=0.7, val_ratio=0.2, test_ratio=0.1, random_state=None):
 
+    from sklearn.model_selection import train_test_split
     total_size = len(dataset)
     indices = list(range(total_size))
 
@@ -256,38 +334,65 @@ def cal_ssim(im1, im2, M):
 
 
 def scale_max(df):
-    result = pd.DataFrame()
-    for label, content in df.items():
-        content = content / content.max()
-        result = pd.concat([result, content], axis=1)
-    return result
+    return df / df.max()
 
 
 def scale_z_score(df):
-    result = pd.DataFrame()
-    for label, content in df.items():
-        content = st.zscore(content)
-        content = pd.DataFrame(content, columns=[label])
-        result = pd.concat([result, content], axis=1)
-    return result
+    # 与 scipy.stats.zscore 相同 (ddof=0), 行索引与原来逐列拼接的结果一样变为 0..n-1
+    values = df.to_numpy(dtype=float, copy=True)
+    values -= values.mean(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values /= np.sqrt(np.einsum('ij,ij->j', values, values) / len(values))
+    return pd.DataFrame(values, columns=df.columns)
 
 
 def scale_plus(df):
-    result = pd.DataFrame()
-    for label, content in df.items():
-        content = content / content.sum()
-        result = pd.concat([result, content], axis=1)
-    return result
+    return df / df.sum()
+
+
+def _column_metric(raw, impute, fill, missing, metric):
+    """对 raw 的每一列 (基因) 计算 metric, 所有基因一次算完
+
+    Args:
+        fill: 缺失值的填充值.
+        missing: impute 中没有的基因记为这个值.
+        metric: metric(raw_values, impute_values) 返回每一列的指标, 两个矩阵的行按位置对应.
+
+    Returns:
+        np.ndarray: 与 raw.columns 顺序相同
+    """
+    present = raw.columns.isin(impute.columns)
+    labels = raw.columns[present]
+    raw_values = raw[labels].fillna(fill).to_numpy(dtype=float)
+    impute_values = impute[labels].fillna(fill).to_numpy(dtype=float)
+    values = np.full(len(raw.columns), missing, dtype=float)
+    # 常数列的 PCC / SSIM 等为 nan, 与逐列计算时相同
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values[present] = metric(raw_values, impute_values)
+    return values
+
+
+def _ssim_min_range(raw_values, impute_values):
+    # 动态范围取两列最大值中较小的一个
+    M = np.minimum(raw_values.max(axis=0), impute_values.max(axis=0))
+    return column_ssim(raw_values, impute_values, M)
+
+
+def _js_entropy(raw_values, impute_values):
+    # 0.5 * entropy(raw, M) + 0.5 * entropy(impute, M), M 在归一化之前取平均
+    M = (raw_values + impute_values) / 2
+    return 0.5 * column_kl(raw_values, M) + 0.5 * column_kl(impute_values, M)
 
 
 def logNorm(df):
+    import scipy.stats as st
     df = np.log1p(df)
     df = st.zscore(df)
     return df
 
 
 class CalculateMeteics:
-    def __init__(self, raw_data, adata_data, genes_name, impute_count_file, prefix, metric):
+    def __init__(self, raw_data, adata_data, genes_name, impute_count_file, prefix, metric, cluster_cache=None):
         self.impute_count_file = impute_count_file
         self.raw_count = pd.DataFrame(raw_data, columns=genes_name)
         self.raw_count.columns = [x.upper() for x in self.raw_count.columns]
@@ -304,6 +409,8 @@ class CalculateMeteics:
         self.impute_count = self.impute_count.fillna(1e-20)
         self.prefix = prefix
         self.metric = metric
+        # ground truth 聚类结果的磁盘缓存目录, None 时只在内存中缓存
+        self.cluster_cache = cluster_cache
 
     def SSIM(self, raw, impute, scale='scale_max'):
         print('---------Calculating SSIM---------')
@@ -313,24 +420,8 @@ class CalculateMeteics:
         else:
             print('Please note you do not scale data by scale max')
         if raw.shape[0] == impute.shape[0]:
-            result = pd.DataFrame()
-            for label in raw.columns:
-                if label not in impute.columns:
-                    ssim = 0
-                else:
-                    raw_col = raw.loc[:, label]
-                    impute_col = impute.loc[:, label]
-                    impute_col = impute_col.fillna(1e-20)
-                    raw_col = raw_col.fillna(1e-20)
-                    M = [raw_col.max(), impute_col.max()][raw_col.max() > impute_col.max()]
-                    raw_col_2 = np.array(raw_col)
-                    raw_col_2 = raw_col_2.reshape(raw_col_2.shape[0], 1)
-                    impute_col_2 = np.array(impute_col)
-                    impute_col_2 = impute_col_2.reshape(impute_col_2.shape[0], 1)
-                    ssim = cal_ssim(raw_col_2, impute_col_2, M)
-
-                ssim_df = pd.DataFrame(ssim, index=["SSIM"], columns=[label])
-                result = pd.concat([result, ssim_df], axis=1)
+            ssim = _column_metric(raw, impute, fill=1e-20, missing=0, metric=_ssim_min_range)
+            result = pd.DataFrame(ssim[None, :], index=["SSIM"], columns=raw.columns)
         else:
             print("columns error")
             return pd.DataFrame()
@@ -346,20 +437,13 @@ class CalculateMeteics:
         else:
             print('Please note you do not scale data by logNorm')
         if raw.shape[0] == impute.shape[0]:
-            result = pd.DataFrame()
-            for label in raw.columns:
-                if label not in impute.columns:
-                    pearsonr = 0
-                else:
-                    raw_col = raw.loc[:, label]
-                    impute_col = impute.loc[:, label]
-                    impute_col = impute_col.fillna(1e2)
-                    raw_col = raw_col.fillna(1e2)
-                    pearsonr, _ = st.pearsonr(raw_col, impute_col)
-                pcc_df = pd.DataFrame(pearsonr, index=["PCC"], columns=[label])
-                result = pd.concat([result, pcc_df], axis=1)
+            # 与 pearsonr 一样截断到 [-1, 1]
+            pearsonr = _column_metric(raw, impute, fill=1e2, missing=0,
+                                      metric=lambda x, y: np.clip(column_pcc(x, y), -1, 1))
+            result = pd.DataFrame(pearsonr[None, :], index=["PCC"], columns=raw.columns)
         else:
             print("columns error")
+            result = pd.DataFrame()
 
         print(result)
         return result
@@ -372,21 +456,11 @@ class CalculateMeteics:
         else:
             print('Please note you do not scale data by plus')
         if raw.shape[0] == impute.shape[0]:
-            result = pd.DataFrame()
-            for label in raw.columns:
-                if label not in impute.columns:
-                    JS = 1
-                else:
-                    raw_col = raw.loc[:, label]
-                    impute_col = impute.loc[:, label]
-                    raw_col = raw_col.fillna(1e-20)
-                    impute_col = impute_col.fillna(1e-20)
-                    M = (raw_col + impute_col) / 2
-                    JS = 0.5 * st.entropy(raw_col, M) + 0.5 * st.entropy(impute_col, M)
-                JS_df = pd.DataFrame(JS, index=["JS"], columns=[label])
-                result = pd.concat([result, JS_df], axis=1)
+            JS = _column_metric(raw, impute, fill=1e-20, missing=1, metric=_js_entropy)
+            result = pd.DataFrame(JS[None, :], index=["JS"], columns=raw.columns)
         else:
             print("columns error")
+            result = pd.DataFrame()
 
         print(result)
         return result
@@ -399,35 +473,24 @@ class CalculateMeteics:
         else:
             print('Please note you do not scale data by zscore')
         if raw.shape[0] == impute.shape[0]:
-            result = pd.DataFrame()
-            for label in raw.columns:
-                if label not in impute.columns:
-                    RMSE = 1.5
-                else:
-                    raw_col = raw.loc[:, label]
-                    impute_col = impute.loc[:, label]
-                    impute_col = impute_col.fillna(1e-20)
-                    raw_col = raw_col.fillna(1e-20)
-                    RMSE = np.sqrt(((raw_col - impute_col) ** 2).mean())
-
-                RMSE_df = pd.DataFrame(RMSE, index=["RMSE"], columns=[label])
-                result = pd.concat([result, RMSE_df], axis=1)
+            RMSE = _column_metric(raw, impute, fill=1e-20, missing=1.5, metric=column_rmse)
+            result = pd.DataFrame(RMSE[None, :], index=["RMSE"], columns=raw.columns)
         else:
             print("columns error")
+            result = pd.DataFrame()
 
         print(result)
         return result
 
     def cluster(self, adata_data, impu, scale=None):
+        import scanpy as sc
         print('---------Calculating cluster---------')
 
         cpy_x = adata_data.copy()
         cpy_x.X = impu
 
-        sc.tl.pca(adata_data)
-        sc.pp.neighbors(adata_data, n_pcs=30, n_neighbors=30)
-        sc.tl.leiden(adata_data)
-        tmp_adata1 = adata_data
+        # ground truth 只聚类一次, 每个方法只需要聚类自己的预测
+        tmp_adata1 = reference_clustering(adata_data, cache_dir=self.cluster_cache)
 
         sc.tl.pca(cpy_x)
         sc.pp.neighbors(cpy_x, n_pcs=30, n_neighbors=30)
@@ -488,7 +551,7 @@ def CalDataMetric(Data, PATH, sp_data, sp_genes, adata_data, out_dir):
             # if not os.path.isfile(prefix + '_Metrics.txt'):
             print(impute_count_file)
             CM = CalculateMeteics(sp_data, adata_data, sp_genes, impute_count_file=impute_count_file, prefix=prefix,
-                                  metric=metric)
+                                  metric=metric, cluster_cache=out_dir)
             CM.compute_all()
 
             # 计算中位数
@@ -0,0 +1,259 @@
+import os
+import json
+import yaml
+import asyncio
+import argparse
+import concurrent.futures
+import torch
+from torch.utils.data import DataLoader, Subset
+from model.diff_model import DiT_diff
+from model.diff_scheduler import NoiseScheduler
+from model.sample import sample_diff
+from model.checkpoint import checkpoint_prefix
+from model.telemetry import build_sink
+from preprocess.data import ConditionalDiffusionDataset
+from preprocess.utils import seed_everything
+
+parser = argparse.ArgumentParser(description='SpaDiT imputation service')
+parser.add_argument("--socket", type=str, default=None)  # 给定时监听 unix socket, 否则监听 host:port
+parser.add_argument("--host", type=str, default='127.0.0.1')
+parser.add_argument("--port", type=int, default=8765)
+parser.add_argument("--device", type=str, default='cuda:0')
+parser.add_argument("--max_batch_genes", type=int, default=2048)
+parser.add_argument("--max_wait_ms", type=float, default=20)
+parser.add_argument("--seed", type=int, default=3407)
+parser.add_argument("--metrics", type=str, nargs='*', default=None)  # 同 main.py, 每次反向扩散输出一次吞吐等指标
+parser.add_argument("--tol", type=float, default=None)  # 同 main.py, 采样提前终止的阈值
+parser.add_argument("--min_step", type=int, default=0)
+
+
+class ImputationService:
+    """按 document 缓存数据集、模型和 scheduler, 每个 dataset 只加载一次
+
+    模型的超参数从 main.py 保存的 save/<doc>_ckpt/<doc>_hyper/<doc>_hyperameters.yaml 中读取
+    """
+
+    def __init__(self, device, metrics_sink=None, tol=None, min_step=0):
+        self.device = device
+        self.metrics_sink = metrics_sink
+        self.tol = tol
+        self.min_step = min_step
+        self.states = {}
+
+    def load(self, document):
+        if document in self.states:
+            return self.states[document]
+
+        with open(f'save/{document}_ckpt/{document}_hyper/{document}_hyperameters.yaml') as yaml_file:
+            hyper = yaml.safe_load(yaml_file)
+        st_path = 'datasets/' + document + '/st/' + document + hyper['st_data']
+        sc_path = 'datasets/' + document + '/sc/' + document + hyper['sc_data']
+        dataset = ConditionalDiffusionDataset(sc_path, st_path)
+
+        model = DiT_diff(
+            st_input_size=dataset.st_data.shape[1],
+            condi_input_size=dataset.sc_data.shape[1],
+            hidden_size=hyper['hidden_size'],
+            depth=hyper['depth'],
+            num_heads=hyper['head'],
+            classes=6,
+            mlp_ratio=4.0,
+            pca_dim=hyper['pca_dim'],
+            dit_type='dit'
+        )
+        directory = 'save/' + document + '_ckpt/' + document + '_scdiff'
+        prefix = checkpoint_prefix(hyper)
+        distill_step = hyper.get('distill_step', 0)
+        if distill_step:
+            # 优先使用渐进蒸馏得到的 student 以及配套的 scheduler
+            distill_prefix = f"{prefix}_d{hyper['distill_epoch'] or hyper['epoch']}_{distill_step}step"
+            model.load_state_dict(torch.load(os.path.join(directory, distill_prefix + '.pt'),
+                                             map_location=self.device))
+            with open(os.path.join(directory, distill_prefix + '.yaml')) as yaml_file:
+                noise_scheduler = NoiseScheduler(device=self.device, **yaml.safe_load(yaml_file))
+        else:
+            model.load_state_dict(torch.load(os.path.join(directory, prefix + '.pt'), map_location=self.device))
+            noise_scheduler = NoiseScheduler(num_timesteps=hyper['diffusion_step'],
+                                             beta_schedule='cosine',
+                                             device=self.device)
+        model.to(self.device)
+        model.eval()
+
+        state = {
+            'dataset': dataset,
+            'gene_index': {gene: i for i, gene in enumerate(dataset.get_gene_names())},
+            'model': model,
+            'noise_scheduler': noise_scheduler,
+            'batch_size': hyper['batch_size'],
+            'is_ddim': bool(distill_step),
+        }
+        self.states[document] = state
+        return state
+
+    def check_genes(self, document, genes):
+        # 有不认识的基因时抛出 KeyError
+        state = self.load(document)
+        missing = [gene for gene in genes if gene not in state['gene_index']]
+        if missing:
+            raise KeyError(f'unknown genes for {document}: {missing}')
+        return state
+
+    def impute(self, document, genes):
+        """对 genes 做一次反向扩散, 返回 {gene: 每个 spot 的预测值}"""
+        state = self.check_genes(document, genes)
+
+        indices = [state['gene_index'][gene] for gene in genes]
+        dataset = state['dataset']
+        subset = Subset(dataset, indices)
+        dataloader = DataLoader(subset, batch_size=state['batch_size'], shuffle=False)
+        gt = dataset.st_sample[indices]
+        num_step = state['noise_scheduler'].num_timesteps
+
+        with torch.no_grad():
+            prediction = sample_diff(state['model'],
+                                     device=self.device,
+                                     dataloader=dataloader,
+                                     noise_scheduler=state['noise_scheduler'],
+                                     mask_nonzero_ratio=0.3,
+                                     mask_zero_ratio=0,
+                                     gt=gt,
+                                     sc=dataset.sc_sample[indices],
+                                     num_step=num_step,
+                                     sample_shape=(gt.shape[0], gt.shape[1]),
+                                     is_condi=True,
+                                     sample_intermediate=num_step,
+                                     model_pred_type='x_start',
+                                     is_classifier_guidance=False,
+                                     omega=0.9,
+                                     is_ddim=state['is_ddim'],
+                                     tol=self.tol,
+                                     min_step=self.min_step,
+                                     is_tqdm=False,
+                                     metrics_sink=self.metrics_sink)
+        return {gene: prediction[i].tolist() for i, gene in enumerate(genes)}
+
+
+class RequestBatcher:
+    """把同一时间窗口内到达的请求合并成一次反向扩散
+
+    同一个 document 的请求取基因的并集只采样一次, 再按各自的基因拆分结果
+    """
+
+    def __init__(self, service, max_batch_genes=2048, max_wait_ms=20):
+        self.service = service
+        self.max_batch_genes = max_batch_genes
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        # 模型只在这一个线程里跑, 事件循环可以继续接收请求
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, document, genes):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((document, genes, future))
+        return await future
+
+    @staticmethod
+    def _set_result(future, result):
+        # 客户端断开时 future 可能已经被取消, 不能再设置结果, 否则 run 会退出, 之后的请求都不会被处理
+        if not future.done():
+            future.set_result(result)
+
+    @staticmethod
+    def _set_exception(future, exception):
+        if not future.done():
+            future.set_exception(exception)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            num_genes = len(requests[0][1])
+            deadline = loop.time() + self.max_wait
+            while num_genes < self.max_batch_genes:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                num_genes += len(request[1])
+
+            by_document = {}
+            for request in requests:
+                by_document.setdefault(request[0], []).append(request)
+            for document, document_requests in by_document.items():
+                try:
+                    await loop.run_in_executor(self.executor, self.service.load, document)
+                except Exception as e:
+                    for _, _, future in document_requests:
+                        self._set_exception(future, e)
+                    continue
+                # 先逐个检查基因名, 有不认识的基因只让这一个请求失败, 不影响同一批的其他请求
+                valid_requests = []
+                for request in document_requests:
+                    if request[2].done():
+                        continue
+                    try:
+                        self.service.check_genes(document, request[1])
+                    except KeyError as e:
+                        self._set_exception(request[2], e)
+                        continue
+                    valid_requests.append(request)
+                if not valid_requests:
+                    continue
+
+                genes = list(dict.fromkeys(gene for _, request_genes, _ in valid_requests
+                                           for gene in request_genes))
+                try:
+                    result = await loop.run_in_executor(self.executor, self.service.impute, document, genes)
+                except Exception as e:
+                    for _, _, future in valid_requests:
+                        self._set_exception(future, e)
+                    continue
+                for _, request_genes, future in valid_requests:
+                    self._set_result(future, {gene: result[gene] for gene in request_genes})
+
+
+async def handle_client(batcher, reader, writer):
+    # 每行一个 json 请求: {"document": "dataset1_MG", "genes": ["Car7", ...]}
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        try:
+            request = json.loads(line)
+            result = await batcher.submit(request['document'], request['genes'])
+            response = {'genes': result}
+        except Exception as e:
+            response = {'error': f'{type(e).__name__}: {e}'}
+        writer.write((json.dumps(response) + '\n').encode())
+        await writer.drain()
+    writer.close()
+
+
+async def serve(args):
+    service = ImputationService(args.device, metrics_sink=build_sink(args.metrics), tol=args.tol,
+                                min_step=args.min_step)
+    batcher = RequestBatcher(service, max_batch_genes=args.max_batch_genes, max_wait_ms=args.max_wait_ms)
+    batch_task = asyncio.create_task(batcher.run())
+
+    def client_connected(reader, writer):
+        return handle_client(batcher, reader, writer)
+
+    if args.socket:
+        server = await asyncio.start_unix_server(client_connected, path=args.socket)
+        print(f'listening on {args.socket}')
+    else:
+        server = await asyncio.start_server(client_connected, host=args.host, port=args.port)
+        print(f'listening on {args.host}:{args.port}')
+    async with server:
+        await server.serve_forever()
+    batch_task.cancel()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    seed_everything(args.seed)
+    asyncio.run(serve(args))
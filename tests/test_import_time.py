@@ -0,0 +1,38 @@
+"""main.py 启动时间的回归测试
+
+用 python -X importtime 导入 main, 检查只在画图 / 评价 / 调参时才需要的重依赖没有被导入,
+并且在 torch 已经导入的前提下, 导入 main 的累计时间不超过 IMPORT_BUDGET 秒. 在仓库根目录运行:
+
+    python -m pytest tests
+"""
+import os
+import sys
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 训练和采样用不到, 只能在对应的函数里导入
+FORBIDDEN = ['tangram', 'scanpy', 'seaborn', 'matplotlib', 'h5py', 'anndata', 'IPython', 'sklearn', 'scipy.stats',
+             'timm', 'ray', 'optuna']
+# torch 之外导入 main 的时间预算 (秒), 目前约 0.5 s; 导入 scanpy 或 timm 各自就要好几秒
+IMPORT_BUDGET = 2.0
+
+
+def import_times(statement):
+    """运行 python -X importtime -c statement, 返回 {模块名: 累计导入时间 (秒)}"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def test_main_import_time():
+    times = import_times('import torch; import main')
+    loaded = [name for name in FORBIDDEN if name in times]
+    assert not loaded, f'import main loads {loaded}'
+    assert times['main'] < IMPORT_BUDGET, f"import main takes {times['main']:.2f}s on top of torch"
@@ -0,0 +1,147 @@
+import os
+import yaml
+import argparse
+import numpy as np
+import torch
+import ray
+from ray import tune, air
+from ray.tune.schedulers import ASHAScheduler
+from ray.tune.search.optuna import OptunaSearch
+from torch.utils.data import DataLoader
+from model.diff_model import DiT_diff
+from model.diff_train import normal_train_diff
+from preprocess.data import ConditionalDiffusionDataset, ConditionTensorDataset
+from preprocess.utils import seed_everything, split_dataset_with_gene_names
+import warnings
+warnings.filterwarnings("ignore")
+
+parser = argparse.ArgumentParser(description='SpaDiT hyperparameter search')
+parser.add_argument("--sc_data", type=str, default='_sc.h5ad')
+parser.add_argument("--st_data", type=str, default='_st.h5ad')
+parser.add_argument("--document", type=str, default='dataset45_ML')
+parser.add_argument("--batch_size", type=int, default=64)
+parser.add_argument("--head", type=int, default=16)
+# DiT_diff.forward 目前不经过 DiT block, depth 只改变参数量不改变模型, 所以不在搜索空间里
+parser.add_argument("--depth", type=int, default=16)
+parser.add_argument("--pca_dim", type=int, default=100)
+# 不同扩散步数的 timestep / 噪声分布不同, 验证损失不可比, 所以扩散步数固定, 不在搜索空间里
+parser.add_argument("--diffusion_step", type=int, default=10)
+# 验证损失只在被 mask 的位置上求和, mask 比例越小损失越小; 所有 trial 都用同一组 mask 比例验证
+parser.add_argument("--valid_mask_nonzero_ratio", type=float, default=0.3)
+parser.add_argument("--valid_mask_zero_ratio", type=float, default=0.1)
+parser.add_argument("--seed", type=int, default=3407)
+parser.add_argument("--num_samples", type=int, default=20)  # trial 总数
+parser.add_argument("--max_epoch", type=int, default=100)  # 每个 trial 最多训练的 epoch 数
+parser.add_argument("--grace_period", type=int, default=5)  # ASHA 淘汰 trial 前至少训练的 epoch 数
+parser.add_argument("--num_cpus", type=int, default=None)  # 本地 ray 使用的 cpu 数, 默认使用全部
+parser.add_argument("--cpus_per_trial", type=int, default=1)
+parser.add_argument("--gpus_per_trial", type=float, default=0)
+
+# 搜索空间, 其余参数与 main.py 的默认值相同
+search_space = {
+    'hidden_size': tune.choice([128, 256, 512]),
+    'learning_rate': tune.loguniform(1e-5, 1e-3),
+    'mask_nonzero_ratio': tune.uniform(0.1, 0.5),
+    'mask_zero_ratio': tune.uniform(0., 0.3),
+}
+
+
+def load_split(args):
+    """读取 h5ad 并划分基因, 只返回 numpy 数组
+
+    numpy 数组放进 ray 的 object store 后各 trial 直接零拷贝读取, 不用每个 trial 重新解析 h5ad.
+    """
+    st_path = 'datasets/' + args.document + '/st/' + args.document + args.st_data
+    sc_path = 'datasets/' + args.document + '/sc/' + args.document + args.sc_data
+    dataset = ConditionalDiffusionDataset(sc_path, st_path)
+    (train_dataset, _), (valid_dataset, _), _ = split_dataset_with_gene_names(dataset, train_ratio=0.7,
+                                                                             val_ratio=0.2, test_ratio=0.1,
+                                                                             random_state=42)
+    return {
+        'train_st': dataset.st_sample[train_dataset.indices].numpy(),
+        'train_sc': dataset.sc_sample[train_dataset.indices].numpy(),
+        'valid_st': dataset.st_sample[valid_dataset.indices].numpy(),
+        'valid_sc': dataset.sc_sample[valid_dataset.indices].numpy(),
+        'sc_data': dataset.sc_data.numpy(),
+    }
+
+
+def train_trial(config, data, args):
+    # 每个 trial 只用分到的 cpu, 避免多个 trial 的线程互相抢占
+    torch.set_num_threads(args.cpus_per_trial)
+    seed_everything(args.seed)
+    device = 'cuda:0' if args.gpus_per_trial > 0 else 'cpu'
+
+    # object store 里的数组是只读的, 训练时只读取不修改, 不需要复制
+    sc_data = torch.from_numpy(data['sc_data'])
+    train_dataset = ConditionTensorDataset(torch.from_numpy(data['train_st']), torch.from_numpy(data['train_sc']),
+                                           sc_data)
+    valid_dataset = ConditionTensorDataset(torch.from_numpy(data['valid_st']), torch.from_numpy(data['valid_sc']),
+                                           sc_data)
+    train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True)
+    valid_dataloader = DataLoader(valid_dataset, batch_size=args.batch_size, shuffle=False)
+
+    model = DiT_diff(
+        st_input_size=train_dataset.st_sample.shape[1],
+        condi_input_size=sc_data.shape[1],
+        hidden_size=config['hidden_size'],
+        depth=args.depth,
+        num_heads=args.head,
+        classes=6,
+        mlp_ratio=4.0,
+        pca_dim=args.pca_dim,
+        dit_type='dit'
+    )
+    # 每个 epoch 通过 session.report 汇报 loss / valid_loss, ASHA 据此提前结束较差的 trial
+    normal_train_diff(model,
+                      dataloader=train_dataloader,
+                      lr=config['learning_rate'],
+                      num_epoch=args.max_epoch,
+                      diffusion_step=args.diffusion_step,
+                      device=device,
+                      pred_type='noise',
+                      is_tqdm=False,
+                      is_tune=True,
+                      mask_nonzero_ratio=config['mask_nonzero_ratio'],
+                      mask_zero_ratio=config['mask_zero_ratio'],
+                      generator=torch.Generator(device=device).manual_seed(args.seed),
+                      valid_dataloader=valid_dataloader,
+                      valid_every=1,
+                      valid_mask_ratios=(args.valid_mask_nonzero_ratio, args.valid_mask_zero_ratio))
+
+
+def run_tune(args):
+    # 不连接集群, 在本机启动一个 ray 节点
+    ray.init(num_cpus=args.num_cpus, include_dashboard=False)
+
+    trainable = tune.with_parameters(train_trial, data=load_split(args), args=args)
+    trainable = tune.with_resources(trainable, {'cpu': args.cpus_per_trial, 'gpu': args.gpus_per_trial})
+    scheduler = ASHAScheduler(time_attr='training_iteration',
+                              max_t=args.max_epoch,
+                              grace_period=args.grace_period,
+                              reduction_factor=2)
+    tuner = tune.Tuner(trainable,
+                       param_space=search_space,
+                       tune_config=tune.TuneConfig(metric='valid_loss',
+                                                   mode='min',
+                                                   search_alg=OptunaSearch(seed=args.seed),
+                                                   scheduler=scheduler,
+                                                   num_samples=args.num_samples),
+                       run_config=air.RunConfig(name=args.document + '_tune'))
+    results = tuner.fit()
+    best = results.get_best_result(metric='valid_loss', mode='min')
+    print(f"best valid_loss: {best.metrics['valid_loss']:.5f}")
+    print(best.config)
+
+    # 保存成 main.py 的参数名, 可以直接对照着传给 main.py
+    hyper_directory = 'save/' + args.document + '_ckpt/' + args.document + '_hyper/'
+    if not os.path.exists(hyper_directory):
+        os.makedirs(hyper_directory)
+    with open(os.path.join(hyper_directory, args.document + '_tune.yaml'), 'w') as yaml_file:
+        yaml.dump({k: (v.item() if isinstance(v, np.generic) else v) for k, v in best.config.items()}, yaml_file)
+    ray.shutdown()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    run_tune(args)